@@ -2,13 +2,18 @@
 Flask 主應用
 雙重浮水印系統
 """
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Request, render_template, request, jsonify, send_from_directory, g
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.serving import is_running_from_reloader
 import os
-from datetime import datetime
-import traceback
 import time
+import logging
+import tempfile
+import orjson
+import multiprocessing
 from functools import wraps
 
 # 自定義服務
@@ -16,9 +21,33 @@ from services.watermark_service import WatermarkService
 from services.image_processor import ImageProcessor
 from services.file_manager import FileManager
 from services.logger_service import logger_service
+from services.cpu_pool import CpuPool
+
+
+
+class ORJSONProvider(JSONProvider):
+    """以 orjson 序列化 JSON 回應，jsonify 的呼叫方式不變"""
+    
+    # numpy 數值（如 estimate_crop 的裁切參數）可直接序列化
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=self.option),
+            mimetype='application/json'
+        )
+
 
 # 初始化 Flask
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # 配置
@@ -26,15 +55,62 @@ app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'bmp', 'gif'}
+app.config['CLEANUP_INTERVAL_MINUTES'] = 30
+app.config['FILE_MAX_AGE_HOURS'] = 24
+# 由前端伺服器（Apache mod_xsendfile / lighttpd）傳送輸出文件
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+# 常用路徑綁定為模組常數，請求處理中不必再查詢 app.config
+UPLOAD_FOLDER = app.config['UPLOAD_FOLDER']
+OUTPUT_FOLDER = app.config['OUTPUT_FOLDER']
 
 # 確保目錄存在
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 # 初始化服務
-watermark_service = WatermarkService(app.config['OUTPUT_FOLDER'])
+watermark_service = WatermarkService(OUTPUT_FOLDER)
 image_processor = ImageProcessor()
-file_manager = FileManager(app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'])
+file_manager = FileManager(UPLOAD_FOLDER, OUTPUT_FOLDER)
+
+# CPU 密集的浮水印運算交由共用進程池執行，多個請求可在多核心上並行
+# （子進程使用 services.cpu_pool 建立的服務實例，跨進程只傳遞名稱、路徑與基本型別參數）
+# 子進程數預設為 CPU 核心數；以 gunicorn 部署時由 gunicorn.conf.py 依 worker 數平分（CPU_POOL_WORKERS）
+cpu_pool = CpuPool(OUTPUT_FOLDER, max_workers=int(os.environ.get('CPU_POOL_WORKERS', 0)) or None)
+submit_cpu_bound = cpu_pool.submit
+run_cpu_bound = cpu_pool.run
+
+
+class UploadRequest(Request):
+    """上傳內容在解析 multipart 時直接寫入上傳目錄的 Request"""
+    
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        stream = file_manager.create_upload_stream(total_content_length)
+        if hasattr(stream, 'name'):
+            self._spooled_paths = getattr(self, '_spooled_paths', [])
+            self._spooled_paths.append(stream.name)
+        return stream
+    
+    def close(self):
+        super().close()
+        # 未被 save_upload 取用的暫存檔（例如參數驗證失敗）在請求結束時刪除
+        for path in getattr(self, '_spooled_paths', ()):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+app.request_class = UploadRequest
+
+# 啟動時的工作（預熱、進程池、清理排程，見檔案末端）只在實際處理請求的進程執行：
+# debug 模式下 reloader 的父進程不執行；以 python app.py 啟動且進程池使用 spawn 時，
+# 子進程會以 __mp_main__ 重新匯入本模組，也不執行
+RUN_STARTUP_TASKS = (
+    multiprocessing.current_process().name == 'MainProcess'
+    and (__name__ != '__main__' or is_running_from_reloader())
+)
 
 
 # ==================== 日誌裝飾器 ====================
@@ -51,6 +127,10 @@ def log_api_call(operation_type):
             try:
                 result = func(*args, **kwargs)
                 
+                # 不記錄 INFO 時略過狀態解析與日誌參數構建
+                if not logger_service.is_enabled_for(logging.INFO):
+                    return result
+                
                 # 如果是 JSON 響應，檢查是否有錯誤
                 if isinstance(result, tuple) and len(result) == 2:
                     response, code = result
@@ -74,27 +154,124 @@ def log_api_call(operation_type):
                 
                 return result
                 
+            except HTTPException:
+                # HTTP 錯誤（如 413）交由對應的 errorhandler 處理與記錄
+                raise
+                
             except Exception as e:
                 processing_time = (time.time() - start_time) * 1000
                 error_message = str(e)
                 
-                # 記錄錯誤日誌
+                # 記錄錯誤日誌（API 端點唯一的錯誤記錄點）
                 logger_service.log_error(
                     error_type=type(e).__name__,
                     error_message=error_message,
                     request=request,
-                    operation_type=operation_type,
+                    operation=operation_type,
                     processing_time=round(processing_time, 2),
-                    traceback=traceback.format_exc()
+                    exc_info=True
                 )
+                g.api_error_logged = True
                 
-                # 重新拋出異常
+                # 重新拋出異常，由 unhandled_exception 回傳錯誤響應
                 raise
         
         return wrapper
     return decorator
 
 
+# ==================== 表單參數解析 ====================
+
+# 明碼浮水印表單欄位: (型別, 預設值)
+_VISIBLE_FORM_SPEC = {
+    'text': (str, '機密文件'),
+    'position': (str, 'grid'),  # 預設為網格模式
+    'opacity': (int, 50),
+    'font_size': (int, 36),
+    'color': (str, '#000000'),
+    # 網格浮水印參數
+    'watermark_x': (int, 20),
+    'watermark_y': (int, 20),
+    'watermark_rows': (int, 0),
+    'watermark_cols': (int, 0),
+    'watermark_x_space': (int, 50),
+    'watermark_y_space': (int, 50),
+    'watermark_angle': (int, 0),
+    'watermark_font': (str, '微軟雅黑'),
+    'watermark_width': (int, None),
+    'watermark_height': (int, None),
+}
+
+
+def _coerce_form(form, spec):
+    """
+    依欄位規格一次讀取並轉換表單參數
+    
+    缺少的欄位使用預設值；數值欄位為空字串時也使用預設值。
+    """
+    params = {}
+    for key, (cast, default) in spec.items():
+        value = form.get(key)
+        if value is None or (not value and cast is not str):
+            params[key] = default
+        else:
+            params[key] = cast(value)
+    return params
+
+
+# ==================== 攻擊參數解析 ====================
+
+def _parse_cut_params(form):
+    """裁剪+縮放"""
+    params = {}
+    if form.get('loc_r_x1'):
+        params['loc_r'] = (
+            (float(form.get('loc_r_x1', 0)), float(form.get('loc_r_y1', 0))),
+            (float(form.get('loc_r_x2', 1)), float(form.get('loc_r_y2', 1)))
+        )
+    if form.get('scale'):
+        params['scale'] = float(form.get('scale'))
+    return params
+
+
+def _parse_resize_params(form):
+    """縮放"""
+    return {'out_shape': (int(form.get('width', 500)), int(form.get('height', 500)))}
+
+
+def _parse_bright_params(form):
+    """亮度調整"""
+    return {'ratio': float(form.get('ratio', 0.8))}
+
+
+def _parse_shelter_params(form):
+    """遮擋"""
+    return {'ratio': float(form.get('ratio', 0.1)), 'n': int(form.get('n', 3))}
+
+
+def _parse_salt_pepper_params(form):
+    """椒鹽噪聲"""
+    return {'ratio': float(form.get('ratio', 0.01))}
+
+
+def _parse_rot_params(form):
+    """旋轉"""
+    return {'angle': float(form.get('angle', 45))}
+
+
+_ATTACK_PARAM_PARSERS = {
+    'cut': _parse_cut_params,
+    'resize': _parse_resize_params,
+    'bright': _parse_bright_params,
+    'shelter': _parse_shelter_params,
+    'salt_pepper': _parse_salt_pepper_params,
+    'rot': _parse_rot_params,
+}
+
+# 結果只取決於輸入與參數的攻擊（遮擋、椒鹽噪聲含隨機性，不重用輸出）
+_DETERMINISTIC_ATTACKS = frozenset({'cut', 'resize', 'bright', 'rot'})
+
+
 # ==================== 路由 ====================
 
 @app.route('/')
@@ -140,101 +317,68 @@ def embed_visible_watermark():
         opacity: 透明度 (0-100)
         font_size: 字體大小
         color: 顏色 (hex)
+    
+    查詢參數:
+        fast: 設為 1 時以低壓縮等級快速編碼輸出 PNG
     """
-    try:
-        # 檢查文件
-        if 'file' not in request.files:
-            return jsonify({'error': '未上傳文件'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': '文件名為空'}), 400
-        
-        if not file_manager.allowed_file(file.filename):
-            return jsonify({'error': '不支援的文件格式'}), 400
-        
-        # 儲存上傳文件
-        input_path = file_manager.save_upload(file)
-        
-        # 獲取參數
-        watermark_text = request.form.get('text', '機密文件')
-        position = request.form.get('position', 'grid')  # 預設為網格模式
-        opacity = int(request.form.get('opacity', 50))
-        font_size = int(request.form.get('font_size', 36))
-        color = request.form.get('color', '#000000')
-        
-        # 網格浮水印參數
-        watermark_x = int(request.form.get('watermark_x', 20))
-        watermark_y = int(request.form.get('watermark_y', 20))
-        watermark_rows = int(request.form.get('watermark_rows', 0))
-        watermark_cols = int(request.form.get('watermark_cols', 0))
-        watermark_x_space = int(request.form.get('watermark_x_space', 50))
-        watermark_y_space = int(request.form.get('watermark_y_space', 50))
-        watermark_angle = int(request.form.get('watermark_angle', 0))
-        watermark_font = request.form.get('watermark_font', '微軟雅黑')
-        watermark_width = request.form.get('watermark_width')
-        watermark_width = int(watermark_width) if watermark_width else None
-        watermark_height = request.form.get('watermark_height')
-        watermark_height = int(watermark_height) if watermark_height else None
-        
-        # 處理圖像
-        output_filename = f"visible_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        image_processor.add_visible_watermark(
+    # 檢查文件
+    if 'file' not in request.files:
+        return jsonify({'error': '未上傳文件'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': '文件名為空'}), 400
+    
+    if not file_manager.allowed_file(file.filename):
+        return jsonify({'error': '不支援的文件格式'}), 400
+    
+    # 儲存上傳文件
+    input_path = file_manager.save_upload(file)
+    
+    # 獲取參數
+    params = _coerce_form(request.form, _VISIBLE_FORM_SPEC)
+    params['fast_encode'] = request.args.get('fast') == '1'
+    watermark_text = params['text']
+    position = params['position']
+    opacity = params['opacity']
+    font_size = params['font_size']
+    
+    # 處理圖像（相同圖像與參數直接重用已有輸出）
+    output_filename = file_manager.cached_output_filename('visible', input_path, params)
+    output_path = file_manager.get_output_path(output_filename)
+    
+    cached = file_manager.reuse_output(output_path)
+    if not cached:
+        run_cpu_bound(
+            'image_processor', 'add_visible_watermark',
             input_path=input_path,
             output_path=output_path,
-            text=watermark_text,
-            position=position,
-            opacity=opacity,
-            font_size=font_size,
-            color=color,
-            watermark_x=watermark_x,
-            watermark_y=watermark_y,
-            watermark_rows=watermark_rows,
-            watermark_cols=watermark_cols,
-            watermark_x_space=watermark_x_space,
-            watermark_y_space=watermark_y_space,
-            watermark_angle=watermark_angle,
-            watermark_font=watermark_font,
-            watermark_width=watermark_width,
-            watermark_height=watermark_height
+            **params
         )
-        
-        # 記錄額外資訊
-        logger_service.log_operation(
-            operation_type='embed_visible',
-            description=f'嵌入明碼浮水印成功: {watermark_text}',
-            ip_address=request.remote_addr,
-            method=request.method,
-            path=request.path,
-            status_code=200,
-            extra_info={
-                'text': watermark_text,
-                'position': position,
-                'opacity': opacity,
-                'font_size': font_size,
-                'output_file': output_filename
-            }
-        )
-        
-        return jsonify({
-            'success': True,
-            'output_path': f'/output/{output_filename}',
-            'message': '明碼浮水印嵌入成功'
-        })
     
-    except Exception as e:
-        error_msg = str(e)
-        app.logger.error(f"Error in embed_visible_watermark: {traceback.format_exc()}")
-        logger_service.log_error(
-            error_type=type(e).__name__,
-            error_message=error_msg,
-            request=request,
-            operation_type='embed_visible',
-            traceback=traceback.format_exc()
-        )
-        return jsonify({'error': error_msg}), 500
+    # 記錄額外資訊
+    logger_service.log_operation(
+        operation_type='embed_visible',
+        description=f'嵌入明碼浮水印成功: {watermark_text}',
+        ip_address=request.remote_addr,
+        method=request.method,
+        path=request.path,
+        status_code=200,
+        extra_info={
+            'text': watermark_text,
+            'position': position,
+            'opacity': opacity,
+            'font_size': font_size,
+            'output_file': output_filename,
+            'cached': cached
+        }
+    )
+    
+    return jsonify({
+        'success': True,
+        'output_path': f'/output/{output_filename}',
+        'message': '明碼浮水印嵌入成功'
+    })
 
 
 @app.route('/api/image/blind/embed', methods=['POST'])
@@ -249,67 +393,63 @@ def embed_blind_watermark():
         password_img: 圖像密碼
         password_wm: 浮水印密碼
     """
-    try:
-        if 'file' not in request.files:
-            return jsonify({'error': '未上傳文件'}), 400
-        
-        file = request.files['file']
-        if not file_manager.allowed_file(file.filename):
-            return jsonify({'error': '不支援的文件格式'}), 400
-        
-        # 儲存上傳文件
-        input_path = file_manager.save_upload(file)
-        
-        # 獲取參數
-        watermark_text = request.form.get('watermark', 'BlindWatermark')
-        password_img = int(request.form.get('password_img', 1))
-        password_wm = int(request.form.get('password_wm', 1))
-        
-        # 嵌入浮水印
-        output_filename = f"blind_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        wm_length = watermark_service.embed_blind_watermark(
+    if 'file' not in request.files:
+        return jsonify({'error': '未上傳文件'}), 400
+    
+    file = request.files['file']
+    if not file_manager.allowed_file(file.filename):
+        return jsonify({'error': '不支援的文件格式'}), 400
+    
+    # 儲存上傳文件
+    input_path = file_manager.save_upload(file)
+    
+    # 獲取參數
+    watermark_text = request.form.get('watermark', 'BlindWatermark')
+    password_img = int(request.form.get('password_img', 1))
+    password_wm = int(request.form.get('password_wm', 1))
+    
+    # 嵌入浮水印（相同圖像與參數直接重用已有輸出）
+    params = {
+        'watermark_text': watermark_text,
+        'password_img': password_img,
+        'password_wm': password_wm,
+    }
+    output_filename = file_manager.cached_output_filename('blind', input_path, params)
+    output_path = file_manager.get_output_path(output_filename)
+    
+    cached = file_manager.reuse_output(output_path)
+    if cached:
+        wm_length = watermark_service.get_wm_length(watermark_text)
+    else:
+        wm_length = run_cpu_bound(
+            'watermark_service', 'embed_blind_watermark',
             input_path=input_path,
             output_path=output_path,
-            watermark_text=watermark_text,
-            password_img=password_img,
-            password_wm=password_wm
-        )
-        
-        # 記錄額外資訊
-        logger_service.log_operation(
-            operation_type='embed_blind',
-            description=f'嵌入隱碼浮水印成功: {watermark_text[:20]}...',
-            ip_address=request.remote_addr,
-            method=request.method,
-            path=request.path,
-            status_code=200,
-            extra_info={
-                'watermark_length': len(watermark_text),
-                'wm_length': wm_length,
-                'output_file': output_filename
-            }
+            **params
         )
-        
-        return jsonify({
-            'success': True,
-            'output_path': f'/output/{output_filename}',
+    
+    # 記錄額外資訊
+    logger_service.log_operation(
+        operation_type='embed_blind',
+        description=f'嵌入隱碼浮水印成功: {watermark_text[:20]}...',
+        ip_address=request.remote_addr,
+        method=request.method,
+        path=request.path,
+        status_code=200,
+        extra_info={
+            'watermark_length': len(watermark_text),
             'wm_length': wm_length,
-            'message': '隱碼浮水印嵌入成功'
-        })
+            'output_file': output_filename,
+            'cached': cached
+        }
+    )
     
-    except Exception as e:
-        error_msg = str(e)
-        app.logger.error(f"Error in embed_blind_watermark: {traceback.format_exc()}")
-        logger_service.log_error(
-            error_type=type(e).__name__,
-            error_message=error_msg,
-            request=request,
-            operation_type='embed_blind',
-            traceback=traceback.format_exc()
-        )
-        return jsonify({'error': error_msg}), 500
+    return jsonify({
+        'success': True,
+        'output_path': f'/output/{output_filename}',
+        'wm_length': wm_length,
+        'message': '隱碼浮水印嵌入成功'
+    })
 
 
 @app.route('/api/image/blind/extract', methods=['POST'])
@@ -324,57 +464,45 @@ def extract_blind_watermark():
         password_img: 圖像密碼
         password_wm: 浮水印密碼
     """
-    try:
-        if 'file' not in request.files:
-            return jsonify({'error': '未上傳文件'}), 400
-        
-        file = request.files['file']
-        input_path = file_manager.save_upload(file)
-        
-        # 獲取參數
-        wm_length = int(request.form.get('wm_length'))
-        password_img = int(request.form.get('password_img', 1))
-        password_wm = int(request.form.get('password_wm', 1))
-        
-        # 提取浮水印
-        extracted_text = watermark_service.extract_blind_watermark(
-            input_path=input_path,
-            wm_length=wm_length,
-            password_img=password_img,
-            password_wm=password_wm
-        )
-        
-        # 記錄額外資訊
-        logger_service.log_operation(
-            operation_type='extract_blind',
-            description=f'提取隱碼浮水印成功: {extracted_text[:20] if extracted_text else "空"}...',
-            ip_address=request.remote_addr,
-            method=request.method,
-            path=request.path,
-            status_code=200,
-            extra_info={
-                'wm_length': wm_length,
-                'extracted_length': len(extracted_text) if extracted_text else 0
-            }
-        )
-        
-        return jsonify({
-            'success': True,
-            'watermark': extracted_text,
-            'message': '隱碼浮水印提取成功'
-        })
+    if 'file' not in request.files:
+        return jsonify({'error': '未上傳文件'}), 400
     
-    except Exception as e:
-        error_msg = str(e)
-        app.logger.error(f"Error in extract_blind_watermark: {traceback.format_exc()}")
-        logger_service.log_error(
-            error_type=type(e).__name__,
-            error_message=error_msg,
-            request=request,
-            operation_type='extract_blind',
-            traceback=traceback.format_exc()
-        )
-        return jsonify({'error': error_msg}), 500
+    file = request.files['file']
+    input_path = file_manager.save_upload(file)
+    
+    # 獲取參數
+    wm_length = int(request.form.get('wm_length'))
+    password_img = int(request.form.get('password_img', 1))
+    password_wm = int(request.form.get('password_wm', 1))
+    
+    # 提取浮水印
+    extracted_text = run_cpu_bound(
+        'watermark_service', 'extract_blind_watermark',
+        input_path=input_path,
+        wm_length=wm_length,
+        password_img=password_img,
+        password_wm=password_wm
+    )
+    
+    # 記錄額外資訊
+    logger_service.log_operation(
+        operation_type='extract_blind',
+        description=f'提取隱碼浮水印成功: {extracted_text[:20] if extracted_text else "空"}...',
+        ip_address=request.remote_addr,
+        method=request.method,
+        path=request.path,
+        status_code=200,
+        extra_info={
+            'wm_length': wm_length,
+            'extracted_length': len(extracted_text) if extracted_text else 0
+        }
+    )
+    
+    return jsonify({
+        'success': True,
+        'watermark': extracted_text,
+        'message': '隱碼浮水印提取成功'
+    })
 
 
 @app.route('/api/image/blind/attack', methods=['POST'])
@@ -388,105 +516,68 @@ def apply_attack():
         attack_type: 攻擊類型 (cut, resize, bright, shelter, salt_pepper, rot)
         其他參數根據攻擊類型而定
     """
-    try:
-        if 'file' not in request.files:
-            return jsonify({'error': '未上傳文件'}), 400
-        
-        file = request.files['file']
-        if not file_manager.allowed_file(file.filename):
-            return jsonify({'error': '不支援的文件格式'}), 400
-        
-        # 儲存上傳文件
-        input_path = file_manager.save_upload(file)
-        
-        # 獲取攻擊類型
-        attack_type = request.form.get('attack_type')
-        if not attack_type:
-            return jsonify({'error': '未指定攻擊類型'}), 400
-        
-        # 準備攻擊參數
-        attack_params = {}
-        
-        if attack_type == 'cut':
-            # 裁剪+縮放
-            if request.form.get('loc_r_x1'):
-                attack_params['loc_r'] = (
-                    (float(request.form.get('loc_r_x1', 0)), float(request.form.get('loc_r_y1', 0))),
-                    (float(request.form.get('loc_r_x2', 1)), float(request.form.get('loc_r_y2', 1)))
-                )
-            if request.form.get('scale'):
-                attack_params['scale'] = float(request.form.get('scale'))
-        
-        elif attack_type == 'resize':
-            # 縮放
-            width = int(request.form.get('width', 500))
-            height = int(request.form.get('height', 500))
-            attack_params['out_shape'] = (width, height)
-        
-        elif attack_type == 'bright':
-            # 亮度調整
-            attack_params['ratio'] = float(request.form.get('ratio', 0.8))
-        
-        elif attack_type == 'shelter':
-            # 遮擋
-            attack_params['ratio'] = float(request.form.get('ratio', 0.1))
-            attack_params['n'] = int(request.form.get('n', 3))
-        
-        elif attack_type == 'salt_pepper':
-            # 椒鹽噪聲
-            attack_params['ratio'] = float(request.form.get('ratio', 0.01))
-        
-        elif attack_type == 'rot':
-            # 旋轉
-            attack_params['angle'] = float(request.form.get('angle', 45))
-        
-        else:
-            return jsonify({'error': f'不支援的攻擊類型: {attack_type}'}), 400
-        
-        # 應用攻擊
-        output_filename = f"attacked_{attack_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        watermark_service.apply_attack(
+    if 'file' not in request.files:
+        return jsonify({'error': '未上傳文件'}), 400
+    
+    file = request.files['file']
+    if not file_manager.allowed_file(file.filename):
+        return jsonify({'error': '不支援的文件格式'}), 400
+    
+    # 儲存上傳文件
+    input_path = file_manager.save_upload(file)
+    
+    # 獲取攻擊類型
+    attack_type = request.form.get('attack_type')
+    if not attack_type:
+        return jsonify({'error': '未指定攻擊類型'}), 400
+    
+    # 準備攻擊參數（每種攻擊只讀取自己需要的欄位）
+    parse_params = _ATTACK_PARAM_PARSERS.get(attack_type)
+    if parse_params is None:
+        return jsonify({'error': f'不支援的攻擊類型: {attack_type}'}), 400
+    attack_params = parse_params(request.form)
+    
+    # 應用攻擊（確定性攻擊可重用相同圖像與參數的已有輸出）
+    if attack_type in _DETERMINISTIC_ATTACKS:
+        output_filename = file_manager.cached_output_filename(
+            f'attacked_{attack_type}', input_path, attack_params
+        )
+    else:
+        output_filename = file_manager.generate_output_filename(f'attacked_{attack_type}')
+    output_path = file_manager.get_output_path(output_filename)
+    
+    cached = attack_type in _DETERMINISTIC_ATTACKS and file_manager.reuse_output(output_path)
+    if not cached:
+        run_cpu_bound(
+            'watermark_service', 'apply_attack',
             input_path=input_path,
             output_path=output_path,
             attack_type=attack_type,
             **attack_params
         )
-        
-        # 記錄額外資訊
-        logger_service.log_operation(
-            operation_type='attack',
-            description=f'攻擊測試完成: {attack_type}',
-            ip_address=request.remote_addr,
-            method=request.method,
-            path=request.path,
-            status_code=200,
-            extra_info={
-                'attack_type': attack_type,
-                'attack_params': attack_params,
-                'output_file': output_filename
-            }
-        )
-        
-        return jsonify({
-            'success': True,
-            'output_path': f'/output/{output_filename}',
+    
+    # 記錄額外資訊
+    logger_service.log_operation(
+        operation_type='attack',
+        description=f'攻擊測試完成: {attack_type}',
+        ip_address=request.remote_addr,
+        method=request.method,
+        path=request.path,
+        status_code=200,
+        extra_info={
             'attack_type': attack_type,
-            'message': '攻擊測試完成'
-        })
+            'attack_params': attack_params,
+            'output_file': output_filename,
+            'cached': cached
+        }
+    )
     
-    except Exception as e:
-        error_msg = str(e)
-        app.logger.error(f"Error in apply_attack: {traceback.format_exc()}")
-        logger_service.log_error(
-            error_type=type(e).__name__,
-            error_message=error_msg,
-            request=request,
-            operation_type='attack',
-            traceback=traceback.format_exc()
-        )
-        return jsonify({'error': error_msg}), 500
+    return jsonify({
+        'success': True,
+        'output_path': f'/output/{output_filename}',
+        'attack_type': attack_type,
+        'message': '攻擊測試完成'
+    })
 
 
 @app.route('/api/image/blind/estimate_crop', methods=['POST'])
@@ -495,40 +586,27 @@ def estimate_crop():
     """
     估算裁剪參數
     """
-    try:
-        if 'original' not in request.files or 'template' not in request.files:
-            return jsonify({'error': '需要上傳原始圖像和模板圖像'}), 400
-        
-        original_file = request.files['original']
-        template_file = request.files['template']
-        
-        # 儲存文件
-        original_path = file_manager.save_upload(original_file)
-        template_path = file_manager.save_upload(template_file)
-        
-        # 估算參數
-        result = watermark_service.estimate_crop_parameters(
-            original_path=original_path,
-            template_path=template_path
-        )
-        
-        return jsonify({
-            'success': True,
-            'result': result,
-            'message': '參數估算完成'
-        })
+    if 'original' not in request.files or 'template' not in request.files:
+        return jsonify({'error': '需要上傳原始圖像和模板圖像'}), 400
     
-    except Exception as e:
-        error_msg = str(e)
-        app.logger.error(f"Error in estimate_crop: {traceback.format_exc()}")
-        logger_service.log_error(
-            error_type=type(e).__name__,
-            error_message=error_msg,
-            request=request,
-            operation_type='estimate_crop',
-            traceback=traceback.format_exc()
-        )
-        return jsonify({'error': error_msg}), 500
+    original_file = request.files['original']
+    template_file = request.files['template']
+    
+    # 儲存文件（兩個文件並行寫入）
+    original_path, template_path = file_manager.save_uploads(original_file, template_file)
+    
+    # 估算參數
+    result = run_cpu_bound(
+        'watermark_service', 'estimate_crop_parameters',
+        original_path=original_path,
+        template_path=template_path
+    )
+    
+    return jsonify({
+        'success': True,
+        'result': result,
+        'message': '參數估算完成'
+    })
 
 
 @app.route('/api/image/blind/recover_crop', methods=['POST'])
@@ -537,62 +615,54 @@ def recover_crop():
     """
     恢復裁剪
     """
-    try:
-        if 'file' not in request.files:
-            return jsonify({'error': '未上傳文件'}), 400
-        
-        file = request.files['file']
-        input_path = file_manager.save_upload(file)
-        
-        # 獲取參數
-        loc = (
-            int(request.form.get('x1')),
-            int(request.form.get('y1')),
-            int(request.form.get('x2')),
-            int(request.form.get('y2'))
-        )
-        image_o_shape = (
-            int(request.form.get('height')),
-            int(request.form.get('width'))
-        )
-        
-        # 恢復
-        output_filename = f"recovered_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        
-        watermark_service.recover_crop(
-            template_path=input_path,
-            output_path=output_path,
-            loc=loc,
-            image_o_shape=image_o_shape
-        )
-        
-        return jsonify({
-            'success': True,
-            'output_path': f'/output/{output_filename}',
-            'message': '裁剪恢復完成'
-        })
+    if 'file' not in request.files:
+        return jsonify({'error': '未上傳文件'}), 400
     
-    except Exception as e:
-        error_msg = str(e)
-        app.logger.error(f"Error in recover_crop: {traceback.format_exc()}")
-        logger_service.log_error(
-            error_type=type(e).__name__,
-            error_message=error_msg,
-            request=request,
-            operation_type='recover_crop',
-            traceback=traceback.format_exc()
-        )
-        return jsonify({'error': error_msg}), 500
+    file = request.files['file']
+    input_path = file_manager.save_upload(file)
+    
+    # 獲取參數
+    loc = (
+        int(request.form.get('x1')),
+        int(request.form.get('y1')),
+        int(request.form.get('x2')),
+        int(request.form.get('y2'))
+    )
+    image_o_shape = (
+        int(request.form.get('height')),
+        int(request.form.get('width'))
+    )
+    
+    # 恢復
+    output_filename = file_manager.generate_output_filename('recovered')
+    output_path = file_manager.get_output_path(output_filename)
+    
+    run_cpu_bound(
+        'watermark_service', 'recover_crop',
+        template_path=input_path,
+        output_path=output_path,
+        loc=loc,
+        image_o_shape=image_o_shape
+    )
+    
+    return jsonify({
+        'success': True,
+        'output_path': f'/output/{output_filename}',
+        'message': '裁剪恢復完成'
+    })
 
 
 @app.route('/output/<filename>')
 def serve_output(filename):
     """提供輸出文件下載"""
-    file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
-    else:
+    try:
+        return send_from_directory(
+            OUTPUT_FOLDER, filename,
+            as_attachment=True, conditional=True,
+            # 輸出檔名唯一（內容雜湊或時間戳+隨機碼），可長期快取
+            max_age=31536000
+        )
+    except NotFound:
         return jsonify({'error': '文件不存在'}), 404
 
 
@@ -624,11 +694,69 @@ def internal_error(error):
         error_type='InternalServerError',
         error_message='伺服器內部錯誤',
         request=request,
-        traceback=traceback.format_exc()
+        exc_info=True
     )
     return jsonify({'error': '伺服器內部錯誤'}), 500
 
 
+@app.errorhandler(Exception)
+def unhandled_exception(error):
+    """未捕獲的異常"""
+    if isinstance(error, HTTPException):
+        return error
+    
+    # API 端點的異常已由 log_api_call 記錄，直接回傳錯誤訊息
+    if g.get('api_error_logged'):
+        return jsonify({'error': str(error)}), 500
+    
+    return internal_error(error)
+
+
+# ==================== 啟動預熱 ====================
+
+def _warmup():
+    """
+    以小圖跑一次明碼與隱碼浮水印，預先載入字體、Pillow/OpenCV 編解碼器與
+    blind_watermark 的運算路徑，避免冷啟動延遲落在第一個使用者請求上。
+    進程池的子進程在預熱後才 fork（cpu_pool.start），會直接繼承預熱後的狀態。
+    """
+    try:
+        from PIL import Image
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, 'warmup.png')
+            Image.new('RGB', (64, 64), (255, 255, 255)).save(input_path)
+            
+            image_processor.add_visible_watermark(
+                input_path=input_path,
+                output_path=os.path.join(tmp_dir, 'visible.png'),
+                text='warmup'
+            )
+            watermark_service.embed_blind_watermark(
+                input_path=input_path,
+                output_path=os.path.join(tmp_dir, 'blind.png'),
+                watermark_text='w'
+            )
+    except Exception as e:
+        # 預熱失敗不影響啟動，第一個請求照常處理
+        logger_service.log_error(
+            error_type='WarmupError',
+            error_message=str(e),
+            exc_info=True
+        )
+
+
+# Flask 3 已移除 before_first_request，改在載入模組時預熱；
+# 預熱後立即 fork 進程池的子進程（繼承預熱後的狀態），之後才啟動背景清理執行緒
+if RUN_STARTUP_TASKS:
+    _warmup()
+    cpu_pool.start()
+    file_manager.start_cleanup_scheduler(
+        interval_minutes=app.config['CLEANUP_INTERVAL_MINUTES'],
+        max_age_hours=app.config['FILE_MAX_AGE_HOURS']
+    )
+
+
 # ==================== 啟動應用 ====================
 
 if __name__ == '__main__':
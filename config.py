@@ -14,6 +14,13 @@ class Config:
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'gif'}
     
+    # 舊檔案清理配置
+    CLEANUP_INTERVAL_MINUTES = 30
+    FILE_MAX_AGE_HOURS = 24
+    
+    # 輸出文件下載由前端伺服器以 X-Sendfile 傳送
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+    
     # 浮水印配置
     DEFAULT_WATERMARK_TEXT = '機密文件'
     DEFAULT_FONT_SIZE = 36
@@ -0,0 +1,25 @@
+"""
+Gunicorn 配置文件
+用於生產環境部署: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+
+# 監聽位址
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# 多進程: 每個 worker 擁有獨立的 GIL，CPU 密集的浮水印運算可在多核心上並行
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+
+# gthread: 每個 worker 以多執行緒處理請求，
+# 上傳儲存、日誌寫入等 I/O 等待期間不會阻塞同一 worker 的其他請求
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# 每個 worker 各有一個運算進程池：子進程數依 worker 數平分 CPU 核心，
+# 明碼浮水印的並行混合執行緒再依子進程總數平分，合計不超過核心數（環境變數已設定時不覆蓋）
+_cpu_count = os.cpu_count() or 1
+os.environ.setdefault('CPU_POOL_WORKERS', str(max(1, _cpu_count // workers)))
+os.environ.setdefault('BLEND_THREADS', str(max(1, _cpu_count // (workers * int(os.environ['CPU_POOL_WORKERS'])))))
+
+# 大圖隱碼浮水印可能耗時較長
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
@@ -0,0 +1,145 @@
+"""
+CPU 密集運算進程池
+浮水印運算在子進程中執行，多個請求可在多核心上並行
+"""
+import os
+import sys
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from services.watermark_service import WatermarkService
+from services.image_processor import ImageProcessor
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 子進程中的服務實例，由 _init_worker 建立
+_services = None
+
+
+def _init_worker(output_folder):
+    """
+    子進程初始化：建立子進程自己的服務實例
+    
+    子進程只匯入本模組與服務模組，不會匯入 app.py，
+    spawn 啟動時不會重新執行 Flask 應用的初始化（清理排程、預熱等）。
+    """
+    global _services
+    _services = {
+        'image_processor': ImageProcessor(),
+        'watermark_service': WatermarkService(output_folder),
+    }
+
+
+def _invoke_service(service_name, method_name, kwargs):
+    """在子進程中執行服務方法"""
+    return getattr(_services[service_name], method_name)(**kwargs)
+
+
+class CpuPool:
+    """CPU 密集運算進程池（子進程異常終止後自動重建）"""
+    
+    def __init__(self, output_folder, max_workers=None, mp_context=None):
+        """
+        Args:
+            output_folder (str): 子進程中 WatermarkService 的輸出目錄
+            max_workers (int): 子進程數量，預設為 CPU 核心數（以 gunicorn 部署時見 CPU_POOL_WORKERS）
+            mp_context: multiprocessing 啟動方式；預設 Windows 使用 spawn，其他平台使用 fork
+        """
+        self.output_folder = output_folder
+        self.max_workers = max_workers or os.cpu_count()
+        
+        # 明確指定啟動方式而不鎖定全域預設值：blind_watermark 延遲載入時會呼叫
+        # multiprocessing.set_start_method('fork')，全域預設值已被使用過時會拋出 RuntimeError
+        self.mp_context = mp_context or multiprocessing.get_context('spawn' if sys.platform == 'win32' else 'fork')
+        
+        # start() 或第一次提交時才建立；子進程異常終止後捨棄並重建
+        self._pool = None
+        self._lock = threading.Lock()
+    
+    def _get_pool(self):
+        """取得目前的進程池（第一次使用或被捨棄後才建立）"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=self.mp_context,
+                    initializer=_init_worker,
+                    initargs=(self.output_folder,)
+                )
+            return self._pool
+    
+    def start(self):
+        """
+        立即建立進程池並啟動子進程
+        
+        fork 會複製呼叫當下的整個進程，應在啟動背景執行緒（清理排程、上傳 I/O 等）之前、
+        由主執行緒呼叫，避免子進程繼承其他執行緒持有中的鎖；
+        fork 啟動方式下第一次提交就會建立全部子進程。
+        """
+        self._get_pool().submit(int).result()
+    
+    def _discard_pool(self, pool):
+        """
+        捨棄已損壞的進程池（子進程被 OOM killer 終止、C 擴充崩潰等）
+        
+        其他請求可能已經重建過，只有目前的進程池仍是 pool 時才捨棄。
+        """
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        logger.warning("運算子進程異常終止，重建進程池")
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _submit(self, service_name, method_name, kwargs):
+        """提交到目前的進程池，回傳 (進程池, Future)；進程池已損壞時重建後重新提交"""
+        pool = self._get_pool()
+        try:
+            return pool, pool.submit(_invoke_service, service_name, method_name, kwargs)
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            pool = self._get_pool()
+            return pool, pool.submit(_invoke_service, service_name, method_name, kwargs)
+    
+    def submit(self, service_name, method_name, **kwargs):
+        """
+        將服務方法提交到進程池，不等待結果
+        
+        批次處理（例如同時嵌入多張圖像）時可先提交全部工作再逐一取得結果，
+        讓多個子進程同時運算。
+        
+        Args:
+            service_name (str): 服務名稱（'image_processor' 或 'watermark_service'）
+            method_name (str): 方法名稱
+            **kwargs: 方法參數（需可序列化）
+        
+        Returns:
+            concurrent.futures.Future: 方法的返回值；子進程中的異常會在 result() 時重新拋出
+        """
+        return self._submit(service_name, method_name, kwargs)[1]
+    
+    def run(self, service_name, method_name, **kwargs):
+        """
+        將服務方法提交到進程池並等待結果
+        
+        執行期間子進程異常終止時，重建進程池後重試一次；再次失敗則拋出 RuntimeError。
+        
+        Args:
+            service_name (str): 服務名稱（'image_processor' 或 'watermark_service'）
+            method_name (str): 方法名稱
+            **kwargs: 方法參數（需可序列化）
+        
+        Returns:
+            方法的返回值；子進程中的異常會在此重新拋出
+        """
+        for _ in range(2):
+            pool, future = self._submit(service_name, method_name, kwargs)
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                self._discard_pool(pool)
+        raise RuntimeError(f"運算子進程異常終止: {service_name}.{method_name}")
@@ -1,9 +1,54 @@
 """
 檔案管理服務
 """
+import io
 import os
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
-from datetime import datetime
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 上傳文件複製緩衝區大小（Werkzeug 預設為 16KB）
+COPY_BUFFER_SIZE = 1 << 20
+
+# 小於此大小的上傳保留在記憶體中（與 Werkzeug 預設相同）
+SPOOL_MAX_MEMORY_SIZE = 500 * 1024
+
+# 允許上傳的副檔名
+ALLOWED_EXTENSIONS = frozenset(('png', 'jpg', 'jpeg', 'bmp', 'gif'))
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    先寫入同目錄的暫存檔，完成後才以 os.replace 換到目標路徑
+    
+    輸出檔名以內容雜湊命名並會被重用（見 FileManager.reuse_output），
+    目標路徑存在即代表文件已完整寫入；寫入中途失敗時刪除暫存檔。
+    暫存檔保留原副檔名，依副檔名決定格式的編碼器（Pillow、cv2.imwrite）可直接使用。
+    
+    Yields:
+        str: 暫存檔路徑
+    """
+    directory, filename = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{uuid.uuid4().hex}{os.path.splitext(filename)[1]}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
 
 
 class FileManager:
@@ -12,21 +57,30 @@ class FileManager:
     def __init__(self, upload_folder, output_folder):
         self.upload_folder = upload_folder
         self.output_folder = output_folder
-        self.allowed_extensions = {'png', 'jpg', 'jpeg', 'bmp', 'gif'}
         
         # 確保目錄存在
         os.makedirs(upload_folder, exist_ok=True)
         os.makedirs(output_folder, exist_ok=True)
+        
+        # 多文件上傳時用於並行寫入
+        self._io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='upload-io')
+        
+        # 背景清理執行緒
+        self._cleanup_thread = None
+        self._cleanup_stop = threading.Event()
     
     def allowed_file(self, filename):
         """檢查文件類型"""
-        return '.' in filename and \
-               filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
+        _, sep, ext = filename.rpartition('.')
+        return bool(sep) and ext.lower() in ALLOWED_EXTENSIONS
     
     def save_upload(self, file, filename=None):
         """
         儲存上傳的檔案
         
+        未指定檔名時以內容雜湊命名，相同內容的上傳會得到相同路徑，
+        可據此重用已處理過的輸出（見 cached_output_filename）。
+        
         Args:
             file: FileStorage 物件
             filename: 可選的自訂檔名
@@ -34,28 +88,125 @@ class FileManager:
         Returns:
             str: 儲存的文件路徑
         """
-        if filename is None:
-            # 生成安全的文件名
-            original_filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            name, ext = os.path.splitext(original_filename)
-            filename = f"{name}_{timestamp}{ext}"
+        if filename is not None:
+            filepath = f"{self.upload_folder}/{secure_filename(filename)}"
+            with open(filepath, 'wb', buffering=COPY_BUFFER_SIZE) as dst:
+                shutil.copyfileobj(file.stream, dst, COPY_BUFFER_SIZE)
+            return filepath
+        
+        digest = hashlib.blake2b(digest_size=8)
+        spooled_path = getattr(file.stream, 'name', None)
+        if isinstance(spooled_path, str) and os.path.dirname(spooled_path) == self.upload_folder:
+            # 內容已由 create_upload_stream 在解析時寫入上傳目錄，只需計算雜湊後改名
+            tmp_path = spooled_path
+            file.stream.seek(0)
+            for chunk in iter(lambda: file.stream.read(COPY_BUFFER_SIZE), b''):
+                digest.update(chunk)
+            file.stream.close()
         else:
-            filename = secure_filename(filename)
+            tmp_path = self._new_part_path()
         
-        # 儲存文件
-        filepath = os.path.join(self.upload_folder, filename)
-        file.save(filepath)
+        try:
+            if tmp_path != spooled_path:
+                # 邊寫入邊計算雜湊（以 1MB 緩衝區串流寫入，減少系統呼叫次數）
+                with open(tmp_path, 'wb', buffering=COPY_BUFFER_SIZE) as dst:
+                    for chunk in iter(lambda: file.stream.read(COPY_BUFFER_SIZE), b''):
+                        digest.update(chunk)
+                        dst.write(chunk)
+            filepath = f"{self.upload_folder}/{digest.hexdigest()}{self._upload_extension(file.filename)}"
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
         
         return filepath
     
+    def create_upload_stream(self, total_content_length):
+        """
+        建立接收 multipart 上傳內容的串流
+        
+        大文件在解析請求時就直接寫入上傳目錄的暫存檔，save_upload 只需改名，
+        不必再整份複製一次；小文件仍留在記憶體中。
+        
+        Args:
+            total_content_length (int): 請求內容總長度（可能為 None）
+        
+        Returns:
+            file: 可讀寫的二進位串流
+        """
+        if total_content_length is not None and total_content_length <= SPOOL_MAX_MEMORY_SIZE:
+            return io.BytesIO()
+        return open(self._new_part_path(), 'wb+', buffering=COPY_BUFFER_SIZE)
+    
+    def _new_part_path(self):
+        """上傳目錄中的暫存檔路徑"""
+        return f"{self.upload_folder}/.{uuid.uuid4().hex}.part"
+    
+    def _upload_extension(self, filename):
+        """取得允許的副檔名（含點），否則回傳空字串"""
+        _, sep, ext = (filename or '').rpartition('.')
+        ext = ext.lower()
+        return f".{ext}" if sep and ext in ALLOWED_EXTENSIONS else ''
+    
+    def save_uploads(self, *files):
+        """
+        並行儲存多個上傳的檔案
+        
+        Args:
+            *files: FileStorage 物件
+        
+        Returns:
+            list: 與輸入順序對應的文件路徑
+        """
+        return list(self._io_pool.map(self.save_upload, files))
+    
+    def generate_output_filename(self, prefix, ext='.png'):
+        """生成不重複的輸出檔名，例如 visible_20240101_120000_1a2b3c4d.png"""
+        return f"{prefix}_{self._unique_suffix()}{ext}"
+    
+    def cached_output_filename(self, prefix, input_path, params, ext='.png'):
+        """
+        以上傳內容雜湊 + 參數雜湊生成輸出檔名，相同輸入與參數得到相同檔名
+        
+        Args:
+            prefix (str): 檔名前綴
+            input_path (str): save_upload 回傳的路徑
+            params (dict): 影響輸出結果的參數
+            ext (str): 副檔名
+        
+        Returns:
+            str: 輸出檔名
+        """
+        input_hash = os.path.splitext(os.path.basename(input_path))[0]
+        params_hash = hashlib.blake2b(
+            repr(sorted(params.items())).encode('utf-8'), digest_size=8
+        ).hexdigest()
+        return f"{prefix}_{input_hash}_{params_hash}{ext}"
+    
+    def reuse_output(self, output_path):
+        """
+        輸出已存在時更新其修改時間（避免被定期清理）並回傳 True
+        
+        輸出都經由 atomic_output 寫入，存在的文件一定已完整寫入。
+        """
+        try:
+            os.utime(output_path)
+            return True
+        except FileNotFoundError:
+            return False
+    
+    def _unique_suffix(self):
+        """時間戳 + 隨機碼，避免同一秒內的請求互相覆蓋"""
+        return f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    
     def get_output_path(self, filename):
         """生成輸出檔案路徑"""
-        return os.path.join(self.output_folder, filename)
+        assert '/' not in filename, filename
+        return f"{self.output_folder}/{filename}"
     
     def cleanup_old_files(self, max_age_hours=24):
         """清理舊檔案"""
-        import time
         current_time = time.time()
         max_age_seconds = max_age_hours * 3600
         
@@ -63,13 +214,40 @@ class FileManager:
             if not os.path.exists(folder):
                 continue
                 
-            for filename in os.listdir(folder):
-                filepath = os.path.join(folder, filename)
-                if os.path.isfile(filepath):
-                    file_age = current_time - os.path.getmtime(filepath)
-                    if file_age > max_age_seconds:
+            # scandir 的 DirEntry 會快取目錄讀取時取得的類型資訊，減少 stat 呼叫
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if current_time - entry.stat().st_mtime > max_age_seconds:
                         try:
-                            os.remove(filepath)
-                        except Exception as e:
-                            print(f"無法刪除檔案 {filepath}: {e}")
-
+                            os.unlink(entry.path)
+                        except OSError as e:
+                            logger.warning(f"無法刪除檔案 {entry.path}: {e}")
+    
+    def start_cleanup_scheduler(self, interval_minutes=30, max_age_hours=24):
+        """
+        啟動背景執行緒，定期清理舊檔案（不佔用請求執行緒）
+        
+        Args:
+            interval_minutes (int): 清理間隔（分鐘）
+            max_age_hours (int): 檔案保留時間（小時）
+        """
+        if self._cleanup_thread is not None:
+            return
+        
+        def run():
+            while True:
+                try:
+                    self.cleanup_old_files(max_age_hours)
+                except Exception as e:
+                    logger.warning(f"清理舊檔案失敗: {e}")
+                if self._cleanup_stop.wait(interval_minutes * 60):
+                    break
+        
+        self._cleanup_thread = threading.Thread(target=run, name='file-cleanup', daemon=True)
+        self._cleanup_thread.start()
+    
+    def stop_cleanup_scheduler(self):
+        """停止背景清理執行緒"""
+        self._cleanup_stop.set()
@@ -3,20 +3,268 @@
 """
 from PIL import Image, ImageDraw, ImageFont
 import os
-import math
+import cv2
+import numpy as np
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+
+from services.file_manager import atomic_output
+
+# 快速編碼時的 PNG 壓縮等級（Pillow 預設為 6）
+FAST_PNG_COMPRESS_LEVEL = 1
+
+# 合成範圍超過此像素數時才分成水平帶並行混合（Pillow 的 paste 執行時釋放 GIL）
+PARALLEL_BLEND_MIN_PIXELS = 1 << 20
+
+# 並行混合的執行緒數；多個進程同時運算時（gunicorn worker × 進程池）
+# 由 gunicorn.conf.py 依 CPU 核心數平分，避免執行緒總數遠超過核心數
+BLEND_THREADS = int(os.environ.get('BLEND_THREADS', 0)) or os.cpu_count() or 1
+
+# 指定字體名稱時優先嘗試的字體文件
+FONT_PATHS_BY_NAME = {
+    '微軟雅黑': ['C:/Windows/Fonts/msyh.ttc', 'C:/Windows/Fonts/msyhbd.ttc'],
+    'arial': ['C:/Windows/Fonts/arial.ttf', '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf'],
+    'times': ['C:/Windows/Fonts/times.ttf'],
+}
+
+# 系統字體
+DEFAULT_FONT_PATHS = [
+    # Windows
+    'C:/Windows/Fonts/arial.ttf',
+    'C:/Windows/Fonts/msyh.ttc',  # 微軟雅黑
+    'C:/Windows/Fonts/simsun.ttc',  # 宋體
+    # Linux
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf',
+    # Mac
+    '/System/Library/Fonts/Helvetica.ttc',
+]
+
+# 快取的文字圖像總大小上限（位元組）；圖像大小取決於文字長度與字體大小（使用者輸入），
+# 每個進程池子進程各有一份，超過上限的單張圖像不快取
+SPRITE_CACHE_MAX_BYTES = 32 << 20
+
+# FreeType 可載入的字體文件副檔名
+FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf')
+
+# 字體大小上限，超過時以此大小繪製（同時限制字體快取鍵的範圍）
+MAX_FONT_SIZE = 1000
+
+
+@lru_cache(maxsize=None)
+def _resolve_font_paths(font_name):
+    """
+    按優先順序列出存在的字體文件（每個字體名稱只檢查一次文件系統）
+    
+    font_name 只會是 FONT_PATHS_BY_NAME 的鍵或 None（見 _load_font），快取項目數量固定。
+    """
+    candidates = FONT_PATHS_BY_NAME.get(font_name, []) + DEFAULT_FONT_PATHS
+    return tuple(
+        path for path in candidates
+        if path.lower().endswith(FONT_EXTENSIONS) and os.path.isfile(path)
+    )
+
+
+def _load_font(font_name, font_size):
+    """
+    載入字體，結果在進程內共用
+    
+    快取以實際候選的字體文件與限制範圍後的大小為鍵：任意的字體名稱與大小（來自表單）
+    只會對應到有限個快取項目，小於 1 的大小都使用預設字體。
+    """
+    # 未知的字體名稱與未指定時相同，使用預設字體清單
+    if font_name not in FONT_PATHS_BY_NAME:
+        font_name = None
+    font_size = min(font_size, MAX_FONT_SIZE) if font_size >= 1 else 0
+    return _load_font_file(_resolve_font_paths(font_name), font_size)
+
+
+@lru_cache(maxsize=64)
+def _load_font_file(font_paths, font_size):
+    """
+    依序嘗試載入字體文件
+    
+    字體文件無法載入（文件損壞、字體大小無效等）時嘗試下一個，都失敗則使用預設字體。
+    """
+    for font_path in font_paths:
+        try:
+            return ImageFont.truetype(font_path, font_size)
+        except (OSError, ValueError):
+            continue
+    return ImageFont.load_default()
+
+
+# 預設浮水印字體與大小（與 add_visible_watermark 的預設參數一致）
+DEFAULT_FONT_NAME = '微軟雅黑'
+DEFAULT_FONT_SIZE = 36
+
+
+_blend_pool = None
+
+
+def _get_blend_pool():
+    """並行混合用的執行緒池（每個進程第一次使用時才建立）"""
+    global _blend_pool
+    if _blend_pool is None:
+        _blend_pool = ThreadPoolExecutor(max_workers=BLEND_THREADS, thread_name_prefix='watermark-blend')
+    return _blend_pool
+
+
+def _reset_blend_pool():
+    # fork 出的子進程（例如 CpuPool 的 worker）不會繼承父進程的執行緒，需重新建立
+    global _blend_pool
+    _blend_pool = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_blend_pool)
+
+
+@lru_cache(maxsize=256)
+def _hex_to_rgb(hex_color):
+    """十六進制顏色轉 RGB"""
+    hex_color = hex_color.lstrip('#')
+    if len(hex_color) == 3:
+        hex_color = ''.join([c*2 for c in hex_color])
+    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+
+
+@lru_cache(maxsize=256)
+def _color_tuple(hex_color, opacity):
+    """十六進制顏色與透明度 (0-100) 轉 RGBA"""
+    return (*_hex_to_rgb(hex_color), int(255 * opacity / 100))
+
+
+@lru_cache(maxsize=256)
+def _text_bbox(font, text):
+    """
+    文字外框 (left, top, right, bottom)
+    
+    以 ImageDraw.textbbox 量測（與繪製時的 draw.text 相同），多行文字依行距計算高度；
+    font.getbbox 會把換行字元當成同一行的字元。
+    字體物件由 _load_font_file 快取共用，同一字體與大小在進程內是同一個物件，可直接作為快取鍵。
+    """
+    return ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), text, font=font)
+
+
+# 文字圖像快取：(函式名稱, 參數...) -> 結果，依最近使用排序
+_sprite_cache = OrderedDict()
+_sprite_cache_bytes = 0
+_sprite_cache_lock = threading.Lock()
+
+
+def _sprite_nbytes(result):
+    """快取結果 (RGBA 圖像, ...) 佔用的位元組數（結果為 None 時為 0）"""
+    if result is None:
+        return 0
+    image = result[0]
+    return image.width * image.height * len(image.getbands())
+
+
+def _cached_sprite(func):
+    """
+    以位元組數為上限快取文字圖像（lru_cache 只能限制項目數量，大字體的圖像可達數十 MB）
+    
+    所有以此裝飾的函式共用 SPRITE_CACHE_MAX_BYTES 的容量。
+    """
+    @wraps(func)
+    def wrapper(*args):
+        global _sprite_cache_bytes
+        key = (func.__name__, *args)
+        with _sprite_cache_lock:
+            if key in _sprite_cache:
+                _sprite_cache.move_to_end(key)
+                return _sprite_cache[key]
+        
+        result = func(*args)
+        nbytes = _sprite_nbytes(result)
+        if nbytes <= SPRITE_CACHE_MAX_BYTES:
+            with _sprite_cache_lock:
+                if key not in _sprite_cache:
+                    while _sprite_cache and _sprite_cache_bytes + nbytes > SPRITE_CACHE_MAX_BYTES:
+                        _sprite_cache_bytes -= _sprite_nbytes(_sprite_cache.popitem(last=False)[1])
+                    _sprite_cache[key] = result
+                    _sprite_cache_bytes += nbytes
+        return result
+    return wrapper
+
+
+@_cached_sprite
+def _render_text_sprite(text, font, color):
+    """
+    渲染未旋轉的浮水印文字
+    
+    Returns:
+        tuple: (大小等於文字外框的 RGBA 圖像, 外框相對繪製座標的 x 偏移, y 偏移)
+    """
+    left, top, right, bottom = _text_bbox(font, text)
+    sprite = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text((-left, -top), text, font=font, fill=color)
+    return sprite, left, top
+
+
+@_cached_sprite
+def _render_rotated_sprite(text, font, color, angle, text_width, text_height):
+    """
+    渲染旋轉後的浮水印文字
+    
+    文字只光柵化成剛好大小的圖像，再以 cv2.warpAffine 旋轉到旋轉後的外框內，
+    不需要為旋轉預留的大正方形畫布。文字為單一顏色，只需旋轉 alpha 通道。
+    
+    Returns:
+        tuple: (裁切到非透明範圍的 RGBA 圖像, 相對文字中心的 x 偏移, y 偏移)，
+        文字完全透明時為 None
+    """
+    sprite, left, top = _render_text_sprite(text, font, color)
+    alpha = np.asarray(sprite.getchannel('A'))
+    height, width = alpha.shape
+    
+    # 以文字外框中心為旋轉中心（座標相對於 sprite 左上角）；
+    # OpenCV 的正角度為逆時針，與 PIL 相同，順時針旋轉需取負
+    center = (text_width / 2 - left, text_height / 2 - top)
+    matrix = cv2.getRotationMatrix2D(center, -angle, 1.0)
+    
+    # 旋轉後四個角的外框，平移到輸出圖像的原點
+    corners = np.array([[0, 0], [width, 0], [0, height], [width, height]], dtype=np.float64)
+    corners = corners @ matrix[:, :2].T + matrix[:, 2]
+    min_x, min_y = np.floor(corners.min(axis=0)).astype(int)
+    max_x, max_y = np.ceil(corners.max(axis=0)).astype(int)
+    matrix[:, 2] -= (min_x, min_y)
+    
+    rotated_alpha = cv2.warpAffine(
+        alpha, matrix, (int(max_x - min_x), int(max_y - min_y)),
+        flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0
+    )
+    rotated = Image.new('RGBA', (rotated_alpha.shape[1], rotated_alpha.shape[0]), (*color[:3], 0))
+    rotated.putalpha(Image.fromarray(rotated_alpha))
+    
+    bbox = rotated.getbbox()
+    if bbox is None:
+        return None
+    offset_x = int(left + min_x + bbox[0]) - text_width // 2
+    offset_y = int(top + min_y + bbox[1]) - text_height // 2
+    return rotated.crop(bbox), offset_x, offset_y
 
 
 class ImageProcessor:
     """圖像處理服務"""
     
+    def __init__(self):
+        # 啟動時先載入預設字體；以路徑載入時 FreeType 會以 mmap 映射字體文件，
+        # 不同大小與進程間共用同一份頁面快取
+        _load_font(DEFAULT_FONT_NAME, DEFAULT_FONT_SIZE)
+    
     def add_visible_watermark(self, input_path, output_path, text, 
                              position='bottomright', opacity=50, 
-                             font_size=36, color='#000000',
+                             font_size=DEFAULT_FONT_SIZE, color='#000000',
                              watermark_x=20, watermark_y=20,
                              watermark_rows=0, watermark_cols=0,
                              watermark_x_space=50, watermark_y_space=50,
-                             watermark_angle=0, watermark_font='微軟雅黑',
-                             watermark_width=None, watermark_height=None):
+                             watermark_angle=0, watermark_font=DEFAULT_FONT_NAME,
+                             watermark_width=None, watermark_height=None,
+                             fast_encode=False):
         """
         添加明碼文字浮水印（支援多個浮水印網格排列）
         
@@ -38,20 +286,19 @@ class ImageProcessor:
             watermark_font (str): 字體名稱
             watermark_width (int): 浮水印寬度 (None=自動)
             watermark_height (int): 浮水印高度 (None=自動)
+            fast_encode (bool): 以低壓縮等級快速編碼 PNG（適合短期存放的輸出）
         """
-        # 開啟圖像
-        image = Image.open(input_path).convert('RGBA')
+        # 開啟圖像：輸出為 RGB，底圖直接轉為 RGB，不建立整張圖的 RGBA 緩衝區
+        image = Image.open(input_path)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
         img_width, img_height = image.size
         
-        # 建立透明圖層
-        watermark_layer = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(watermark_layer)
-        
         # 載入字體
         font = self._get_font(font_size, watermark_font)
         
         # 計算文字尺寸
-        bbox = draw.textbbox((0, 0), text, font=font)
+        bbox = _text_bbox(font, text)
         text_width = bbox[2] - bbox[0]
         text_height = bbox[3] - bbox[1]
         
@@ -60,9 +307,12 @@ class ImageProcessor:
         wm_height = watermark_height if watermark_height else text_height
         
         # 解析顏色
-        rgb = self._hex_to_rgb(color)
-        alpha = int(255 * opacity / 100)
-        text_color = (*rgb, alpha)
+        text_color = _color_tuple(color, opacity)
+        
+        # 旋轉後的文字每個請求只渲染一次，所有格子共用（太大而不進快取時也不會逐格重新渲染）
+        rotated_sprite = None
+        if watermark_angle != 0:
+            rotated_sprite = _render_rotated_sprite(text, font, text_color, watermark_angle, text_width, text_height)
         
         # 判斷是單個浮水印還是網格浮水印
         if position in ['topleft', 'topright', 'center', 'bottomleft', 'bottomright']:
@@ -71,7 +321,8 @@ class ImageProcessor:
                 position, img_width, img_height, 
                 text_width, text_height
             )
-            self._draw_watermark_text(watermark_layer, draw, text, x, y, font, text_color, watermark_angle, text_width, text_height)
+            watermark_layer, draw = self._new_layer(image.size)
+            dirty_box = self._draw_watermark_text(watermark_layer, draw, text, x, y, font, text_color, watermark_angle, text_width, text_height, rotated_sprite)
         else:
             # 網格浮水印模式
             # 計算可用的空間
@@ -84,94 +335,125 @@ class ImageProcessor:
             if watermark_rows == 0:
                 watermark_rows = max(1, int((available_height) / (wm_height + watermark_y_space)))
             
+            # 無旋轉且各格互不重疊時，文字只光柵化一次，之後直接混合到底圖的每一格，
+            # 不需要整張圖大小的透明圖層；否則先繪製到圖層再一次合成
+            stamp = None
+            watermark_layer = draw = None
+            if (watermark_angle == 0 and wm_width + watermark_x_space >= text_width
+                    and wm_height + watermark_y_space >= text_height):
+                stamp = _render_text_sprite(text, font, text_color)
+            else:
+                watermark_layer, draw = self._new_layer(image.size)
+            
+            # 各格座標一次算出，並先排除超出圖像範圍的行與列
+            xs = watermark_x + np.arange(watermark_cols) * (wm_width + watermark_x_space)
+            ys = watermark_y + np.arange(watermark_rows) * (wm_height + watermark_y_space)
+            xs = xs[xs + wm_width <= img_width].tolist()
+            ys = ys[ys + wm_height <= img_height].tolist()
+            
             # 繪製網格浮水印
-            for row in range(watermark_rows):
-                for col in range(watermark_cols):
-                    x = watermark_x + col * (wm_width + watermark_x_space)
-                    y = watermark_y + row * (wm_height + watermark_y_space)
-                    
-                    # 檢查是否超出圖像範圍
-                    if x + wm_width <= img_width and y + wm_height <= img_height:
-                        self._draw_watermark_text(watermark_layer, draw, text, x, y, font, text_color, watermark_angle, text_width, text_height)
-        
-        # 合併圖層
-        watermarked = Image.alpha_composite(image, watermark_layer)
-        
-        # 轉換為 RGB 並儲存
-        watermarked = watermarked.convert('RGB')
-        watermarked.save(output_path)
-    
-    def _draw_watermark_text(self, watermark_layer, draw, text, x, y, font, color, angle, text_width, text_height):
-        """繪製帶旋轉的浮水印文字"""
+            dirty_box = None
+            for y in ys:
+                for x in xs:
+                    if stamp is not None:
+                        self._blend_stamp(image, stamp, x, y)
+                    else:
+                        box = self._draw_watermark_text(watermark_layer, draw, text, x, y, font, text_color, watermark_angle, text_width, text_height, rotated_sprite)
+                        dirty_box = self._union_box(dirty_box, box)
+        
+        # 合併圖層：圖層其餘部分完全透明，只需合成實際繪製過的範圍
+        if dirty_box is not None:
+            left, top, right, bottom = dirty_box
+            dirty_box = (max(left, 0), max(top, 0), min(right, img_width), min(bottom, img_height))
+            if dirty_box[0] < dirty_box[2] and dirty_box[1] < dirty_box[3]:
+                self._blend_layer(image, watermark_layer, dirty_box)
+        
+        # 儲存（寫入暫存檔後才換到輸出路徑）
+        with atomic_output(output_path) as tmp_path:
+            if fast_encode:
+                image.save(tmp_path, compress_level=FAST_PNG_COMPRESS_LEVEL)
+            else:
+                image.save(tmp_path)
+    
+    def _draw_watermark_text(self, watermark_layer, draw, text, x, y, font, color, angle, text_width, text_height,
+                             rotated_sprite=None):
+        """
+        繪製帶旋轉的浮水印文字
+        
+        Args:
+            rotated_sprite (tuple): angle 不為 0 時，_render_rotated_sprite 的結果
+        
+        Returns:
+            tuple: 實際繪製範圍 (left, top, right, bottom)，未繪製任何像素時為 None
+        """
         if angle == 0:
             # 無旋轉，直接繪製
             draw.text((x, y), text, font=font, fill=color)
+            return draw.textbbox((x, y), text, font=font)
         else:
-            # 需要旋轉：創建臨時圖像
-            # 計算所需尺寸（考慮旋轉）
-            margin = int(math.sqrt(text_width**2 + text_height**2)) + 50
-            temp_size = max(text_width, text_height) + margin * 2
-            
-            # 創建臨時圖像
-            temp_img = Image.new('RGBA', (temp_size, temp_size), (0, 0, 0, 0))
-            temp_draw = ImageDraw.Draw(temp_img)
-            
-            # 在臨時圖像中心繪製文字
-            temp_x = (temp_size - text_width) // 2
-            temp_y = (temp_size - text_height) // 2
-            temp_draw.text((temp_x, temp_y), text, font=font, fill=color)
-            
-            # 旋轉臨時圖像（注意：PIL 的 rotate 角度是逆時針，我們需要取負）
-            rotated = temp_img.rotate(-angle, expand=False, center=(temp_size//2, temp_size//2))
+            # 需要旋轉：旋轉後的文字由呼叫端渲染一次，網格的每一格直接貼上
+            if rotated_sprite is None:
+                return None
+            rotated, offset_x, offset_y = rotated_sprite
             
             # 計算貼圖位置（使旋轉後的文字中心對齊原位置）
-            center_x = x + text_width // 2
-            center_y = y + text_height // 2
-            paste_x = center_x - temp_size // 2
-            paste_y = center_y - temp_size // 2
+            paste_x = x + text_width // 2 + offset_x
+            paste_y = y + text_height // 2 + offset_y
             
             # 將旋轉後的圖像合成到浮水印圖層
             watermark_layer.paste(rotated, (paste_x, paste_y), rotated)
+            return (paste_x, paste_y, paste_x + rotated.width, paste_y + rotated.height)
+    
+    def _blend_layer(self, image, watermark_layer, box):
+        """
+        以圖層的 alpha 為遮罩，將 box 範圍混合到 RGB 底圖
+        
+        範圍夠大且 BLEND_THREADS 大於 1 時，切成互不重疊的水平帶由執行緒池並行處理。
+        """
+        left, top, right, bottom = box
+        workers = BLEND_THREADS
+        if workers == 1 or (right - left) * (bottom - top) < PARALLEL_BLEND_MIN_PIXELS:
+            region = watermark_layer.crop(box)
+            image.paste(region, box[:2], region)
+            return
+        
+        # 先載入底圖，避免各執行緒同時觸發延遲載入
+        image.load()
+        
+        def blend_band(band):
+            region = watermark_layer.crop(band)
+            image.paste(region, band[:2], region)
+        
+        step = -(-(bottom - top) // workers)
+        bands = [(left, y, right, min(y + step, bottom)) for y in range(top, bottom, step)]
+        list(_get_blend_pool().map(blend_band, bands))
+    
+    def _new_layer(self, size):
+        """建立透明浮水印圖層與其繪圖物件"""
+        watermark_layer = Image.new('RGBA', size, (0, 0, 0, 0))
+        return watermark_layer, ImageDraw.Draw(watermark_layer)
+    
+    def _blend_stamp(self, image, stamp, x, y):
+        """
+        將預先渲染的文字以其 alpha 為遮罩混合到底圖的 (x, y)
+        
+        只適用於各格互不重疊的情況，結果等同於先繪製到透明圖層再合成。
+        """
+        sprite, offset_x, offset_y = stamp
+        image.paste(sprite, (x + offset_x, y + offset_y), sprite)
+    
+    def _union_box(self, box_a, box_b):
+        """兩個矩形的聯集外框（None 表示空）"""
+        if box_a is None:
+            return box_b
+        if box_b is None:
+            return box_a
+        return (min(box_a[0], box_b[0]), min(box_a[1], box_b[1]),
+                max(box_a[2], box_b[2]), max(box_a[3], box_b[3]))
     
     def _get_font(self, font_size, font_name=None):
-        """獲取字體"""
-        # 如果指定了字體名稱，優先嘗試
-        if font_name:
-            font_paths_by_name = {
-                '微軟雅黑': ['C:/Windows/Fonts/msyh.ttc', 'C:/Windows/Fonts/msyhbd.ttc'],
-                'arial': ['C:/Windows/Fonts/arial.ttf', '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf'],
-                'times': ['C:/Windows/Fonts/times.ttf'],
-            }
-            if font_name in font_paths_by_name:
-                for font_path in font_paths_by_name[font_name]:
-                    if os.path.exists(font_path):
-                        try:
-                            return ImageFont.truetype(font_path, font_size)
-                        except:
-                            continue
-        
-        # 嘗試載入系統字體
-        font_paths = [
-            # Windows
-            'C:/Windows/Fonts/arial.ttf',
-            'C:/Windows/Fonts/msyh.ttc',  # 微軟雅黑
-            'C:/Windows/Fonts/simsun.ttc',  # 宋體
-            # Linux
-            '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
-            '/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf',
-            # Mac
-            '/System/Library/Fonts/Helvetica.ttc',
-        ]
-        
-        for font_path in font_paths:
-            if os.path.exists(font_path):
-                try:
-                    return ImageFont.truetype(font_path, font_size)
-                except:
-                    continue
-        
-        # 如果都失敗，使用預設字體
-        return ImageFont.load_default()
+        """獲取字體（同一字體與大小在進程內只載入一次）"""
+        return _load_font(font_name, font_size)
     
     def _calculate_position(self, position, img_width, img_height, 
                            text_width, text_height):
@@ -190,7 +472,4 @@ class ImageProcessor:
     
     def _hex_to_rgb(self, hex_color):
         """十六進制顏色轉 RGB"""
-        hex_color = hex_color.lstrip('#')
-        if len(hex_color) == 3:
-            hex_color = ''.join([c*2 for c in hex_color])
-        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+        return _hex_to_rgb(hex_color)
@@ -4,38 +4,131 @@
 """
 import os
 import csv
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import traceback
 from datetime import datetime
 from functools import wraps
 
+# 通知背景寫入執行緒結束
+_STOP = object()
+
+# 不寫入日誌的敏感表單欄位
+SENSITIVE_FORM_KEYS = frozenset({'password', 'password_img', 'password_wm'})
+
 
 class LoggerService:
     """日誌服務"""
     
-    def __init__(self, log_dir='logs'):
+    def __init__(self, log_dir='logs', level=logging.INFO):
         self.log_dir = log_dir
         os.makedirs(log_dir, exist_ok=True)
+        
+        # 成功請求記錄 INFO，錯誤記錄 ERROR；低於此等級的日誌直接略過
+        self._level = self._parse_level(level)
+        
+        # 當天日誌文件保持開啟，只由背景寫入執行緒寫入
+        self._fp = None
+        self._writer = None
+        self._current_path = None
+        self._closed = False
+        self._cached_second = None
+        self._cached_prefix = ''
+        
+        # 請求執行緒只負責入隊，格式化與文件寫入由背景執行緒完成
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._drain, name='operation-log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def _parse_level(self, level):
+        """
+        將日誌等級（數值或名稱，不分大小寫）轉為數值
+        
+        Raises:
+            ValueError: 未知的等級名稱（設定錯誤在啟動時就失敗，而不是每個請求都出錯）
+        """
+        if isinstance(level, int):
+            return level
+        levels = logging.getLevelNamesMapping()
+        name = str(level).strip().upper()
+        if name not in levels:
+            raise ValueError(f"未知的日誌等級: {level}，可用等級: {', '.join(levels)}")
+        return levels[name]
     
-    def _get_log_file_path(self):
-        """獲取當天的日誌文件路徑"""
-        today = datetime.now().strftime('%Y-%m-%d')
+    def close(self):
+        """停止背景寫入執行緒並關閉日誌文件（寫完佇列中剩餘的日誌）"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+    
+    def is_enabled_for(self, level):
+        """指定等級的日誌是否會被記錄（成功請求記錄 INFO，錯誤記錄 ERROR）"""
+        return level >= self._level
+    
+    def _drain(self):
+        """背景寫入執行緒：依序寫入佇列中的日誌，佇列清空時才 flush"""
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            self._write_row(*item)
+            if self._queue.empty() and self._fp is not None:
+                self._fp.flush()
+    
+    def _get_log_file_path(self, today=None):
+        """獲取當天（或指定日期 YYYY-MM-DD）的日誌文件路徑"""
+        if today is None:
+            today = datetime.now().strftime('%Y-%m-%d')
         filename = f"watermark_system_{today}.csv"
         return os.path.join(self.log_dir, filename)
     
-    def _ensure_csv_header(self, filepath):
-        """確保 CSV 文件有標題行"""
-        if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
-            with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    '時間戳', '操作類型', '操作描述', 'IP地址', 
-                    '請求方法', '請求路徑', '狀態碼', '錯誤訊息', 
-                    '處理時間(ms)', '額外資訊'
-                ])
+    def _format_timestamp(self, created):
+        """
+        格式化時間戳（背景執行緒）
+        
+        同一秒內的日誌共用已格式化的日期與時間，只補上毫秒。
+        
+        Returns:
+            tuple: ('YYYY-MM-DD HH:MM:SS.mmm', 'YYYY-MM-DD')
+        """
+        second = int(created)
+        if second != self._cached_second:
+            self._cached_second = second
+            self._cached_prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        return f"{self._cached_prefix}.{int((created - second) * 1000):03d}", self._cached_prefix[:10]
+    
+    def _open_log_file(self, filepath):
+        """切換到指定的日誌文件，新文件先寫入標題行"""
+        if self._fp is not None:
+            self._fp.close()
+        
+        self._fp = open(filepath, 'a', newline='', encoding='utf-8-sig', buffering=65536)
+        self._writer = csv.writer(self._fp)
+        self._current_path = filepath
+        
+        if self._fp.tell() == 0:
+            self._writer.writerow([
+                '時間戳', '操作類型', '操作描述', 'IP地址', 
+                '請求方法', '請求路徑', '狀態碼', '錯誤訊息', 
+                '處理時間(ms)', '額外資訊'
+            ])
     
     def log_operation(self, operation_type, description, 
                      ip_address=None, method=None, path=None, 
                      status_code=200, error_message=None, 
-                     processing_time=None, extra_info=None):
+                     processing_time=None, extra_info=None, exc_info=None,
+                     description_args=()):
         """
         記錄操作日誌
         
@@ -47,7 +140,7 @@ class LoggerService:
                 - 'attack': 攻擊測試
                 - 'error': 錯誤
                 - 'page_view': 頁面訪問
-            description (str): 操作描述
+            description (str): 操作描述（可含 %s 佔位符，搭配 description_args）
             ip_address (str): 客戶端 IP
             method (str): HTTP 方法
             path (str): 請求路徑
@@ -55,55 +148,73 @@ class LoggerService:
             error_message (str): 錯誤訊息（如果有）
             processing_time (float): 處理時間（毫秒）
             extra_info (dict): 額外資訊（JSON 字符串）
+            exc_info: 異常資訊（True 表示當前異常），traceback 於寫入時才格式化
+            description_args (tuple): 描述的格式化參數，於寫入時才格式化
         """
         try:
-            filepath = self._get_log_file_path()
-            self._ensure_csv_header(filepath)
+            level = logging.ERROR if error_message or exc_info else logging.INFO
+            if level < self._level:
+                return
+            if exc_info is True:
+                exc_info = sys.exc_info()
             
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+            # 入隊後立即返回，由背景執行緒填入時間戳、描述並寫入
+            self._queue.put((time.time(), [
+                None,
+                operation_type,
+                None,
+                ip_address or '',
+                method or '',
+                path or '',
+                status_code,
+                error_message or '',
+                processing_time or '',
+                extra_info
+            ], description, description_args, exc_info))
+        except Exception as e:
+            # 日誌記錄失敗不應影響主程序
+            print(f"日誌記錄失敗: {e}")
+    
+    def _write_row(self, created, row, description, description_args, exc_info):
+        """寫入一列日誌到當天的 CSV 文件（背景執行緒）"""
+        try:
+            # 時間戳與描述在背景執行緒才格式化，使用入隊時的時間
+            row[0], today = self._format_timestamp(created)
+            row[2] = description % description_args if description_args else description
+            
+            filepath = self._get_log_file_path(today)
+            if filepath != self._current_path:
+                self._open_log_file(filepath)
             
             # 將額外資訊轉為 JSON 字符串
+            extra_info = row[-1]
+            if exc_info:
+                extra_info = dict(extra_info) if isinstance(extra_info, dict) else {}
+                extra_info['traceback'] = ''.join(traceback.format_exception(*exc_info))
             if extra_info and isinstance(extra_info, dict):
-                import json
-                extra_info_str = json.dumps(extra_info, ensure_ascii=False)
+                row[-1] = json.dumps(extra_info, ensure_ascii=False)
             else:
-                extra_info_str = str(extra_info) if extra_info else ''
+                row[-1] = str(extra_info) if extra_info else ''
             
-            # 寫入 CSV
-            with open(filepath, 'a', newline='', encoding='utf-8-sig') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    timestamp,
-                    operation_type,
-                    description,
-                    ip_address or '',
-                    method or '',
-                    path or '',
-                    status_code,
-                    error_message or '',
-                    processing_time or '',
-                    extra_info_str
-                ])
+            # 寫入 CSV（flush 由 _drain 在佇列清空時執行，忙碌時多筆日誌合併成一次寫入）
+            self._writer.writerow(row)
         except Exception as e:
-            # 日誌記錄失敗不應影響主程序
             print(f"日誌記錄失敗: {e}")
     
     def log_api_request(self, operation_type, request, status_code=200, 
-                       error_message=None, processing_time=None, **kwargs):
+                       error_message=None, processing_time=None, exc_info=None,
+                       **kwargs):
         """記錄 API 請求"""
         ip_address = request.remote_addr if request else None
         method = request.method if request else None
         path = request.path if request else None
         
-        # 構建描述
-        description = f"{operation_type} - {path or 'unknown'}"
-        
         # 構建額外資訊
         extra_info = {}
         if request and request.form:
             # 記錄表單參數（排除敏感資訊）
             for key, value in request.form.items():
-                if key not in ['password', 'password_img', 'password_wm']:
+                if key not in SENSITIVE_FORM_KEYS:
                     extra_info[key] = str(value)[:100]  # 限制長度
         
         if kwargs:
@@ -111,36 +222,47 @@ class LoggerService:
         
         self.log_operation(
             operation_type=operation_type,
-            description=description,
+            description='%s - %s',
+            description_args=(operation_type, path or 'unknown'),
             ip_address=ip_address,
             method=method,
             path=path,
             status_code=status_code,
             error_message=error_message,
             processing_time=processing_time,
-            extra_info=extra_info if extra_info else None
+            extra_info=extra_info if extra_info else None,
+            exc_info=exc_info
         )
     
-    def log_error(self, error_type, error_message, request=None, **kwargs):
+    def log_error(self, error_type, error_message, request=None, exc_info=None, **kwargs):
         """記錄錯誤"""
         self.log_api_request(
             operation_type='error',
             request=request,
             status_code=500,
             error_message=f"{error_type}: {error_message}",
+            exc_info=exc_info,
             **kwargs
         )
     
     def log_page_view(self, page_name, request=None):
-        """記錄頁面訪問"""
-        self.log_api_request(
+        """
+        記錄頁面訪問
+        
+        頁面請求沒有表單參數，直接入隊而不經過 log_api_request 的表單掃描。
+        """
+        path = request.path if request else None
+        self.log_operation(
             operation_type='page_view',
-            request=request,
-            status_code=200,
+            description='page_view - %s',
+            description_args=(path or 'unknown',),
+            ip_address=request.remote_addr if request else None,
+            method=request.method if request else None,
+            path=path,
             extra_info={'page': page_name}
         )
 
 
 # 全域日誌服務實例
-logger_service = LoggerService()
+logger_service = LoggerService(level=os.environ.get('OPERATION_LOG_LEVEL', 'INFO'))
 
@@ -2,19 +2,314 @@
 浮水印服務統一介面
 使用 blind_watermark 庫實現隱碼浮水印功能
 """
-from blind_watermark import WaterMark, att, recover
+from PIL import Image
 import os
 import cv2
 import numpy as np
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 import logging
 
+from services.file_manager import atomic_output
+
 # 設置日誌
 logger = logging.getLogger(__name__)
 
+# JPEG 縮小解碼：(縮小倍數, imread 旗標)，由大到小嘗試
+REDUCED_READ_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# 4x4 正交 DCT-II 矩陣：DCT4 @ B @ DCT4.T 與 cv2.dct(B) 相同
+DCT4 = cv2.dct(np.eye(4), flags=cv2.DCT_ROWS).T
+
+# EXIF 方向標籤中表示旋轉 90/270 度（寬高互換）的值
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = frozenset({5, 6, 7, 8})
+
+# JPEG 副檔名；PyTurboJPEG 可用時這類文件改由 libjpeg-turbo 直接編解碼
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+# JPEG 編碼參數，與 cv2.imwrite 的預設值（品質 95、4:2:0 取樣）一致
+JPEG_QUALITY = 95
+
+# 旋轉攻擊可選的插值方式（預設 linear，與 att.rot_att 相同）
+ROT_INTERPOLATIONS = {
+    'linear': cv2.INTER_LINEAR,
+    'nearest': cv2.INTER_NEAREST,
+}
+
+# 縮放攻擊可選的插值方式（預設 linear，與 att.resize_att 相同；
+# area 縮小時品質較好，但非整數倍縮小時比 linear 慢數倍）
+RESIZE_INTERPOLATIONS = {
+    'linear': cv2.INTER_LINEAR,
+    'area': cv2.INTER_AREA,
+    'nearest': cv2.INTER_NEAREST,
+}
+
+# 已解碼圖像快取的容量上限（位元組），預設 0 表示不快取。
+# 網頁請求各自讀取不同的上傳文件且分散在不同子進程，快取幾乎不會命中；
+# 在同一進程中對同一輸入連續嵌入、攻擊、提取的批次腳本可設定 DECODE_CACHE_MAX_MB
+# 或呼叫 set_decode_cache_limit 啟用
+DECODE_CACHE_MAX_BYTES = int(os.environ.get('DECODE_CACHE_MAX_MB', 0)) << 20
+
+# 快取閒置 WaterMark 實例的密碼組合數量上限
+BWM_CACHE_MAX_KEYS = 32
+
+# apply_attack_async 背景寫檔的執行緒數
+IO_POOL_WORKERS = 2
+
+# blind_watermark 於第一次使用時才載入（見 _load_blind_watermark）
+WaterMark = att = recover = random_strategy1 = one_dim_kmeans = idwt2 = None
+
+
+def _load_blind_watermark():
+    """
+    載入 blind_watermark 並快取到模組全域變數
+    
+    blind_watermark 會連帶載入 PyWavelets，只匯入本模組（例如只做明碼浮水印或
+    檔案管理的進程）時不需要付出這個成本。
+    """
+    global WaterMark, att, recover, random_strategy1, one_dim_kmeans, idwt2
+    if WaterMark is None:
+        from blind_watermark import WaterMark as _WaterMark, att as _att, recover as _recover
+        from blind_watermark.bwm_core import random_strategy1 as _strategy, one_dim_kmeans as _kmeans
+        from pywt import idwt2 as _idwt2
+        att, recover, idwt2 = _att, _recover, _idwt2
+        random_strategy1, one_dim_kmeans = _strategy, _kmeans
+        WaterMark = _WaterMark
+
+
+_turbo_jpeg = None
+
+
+def _get_turbo_jpeg():
+    """
+    PyTurboJPEG 實例（選用依賴，每個進程第一次使用時才載入）
+    
+    Returns:
+        TurboJPEG: 未安裝 PyTurboJPEG 或找不到 libturbojpeg 時為 None
+    """
+    global _turbo_jpeg
+    if _turbo_jpeg is None:
+        try:
+            from turbojpeg import TurboJPEG
+            _turbo_jpeg = TurboJPEG()
+        except (ImportError, OSError, RuntimeError):
+            _turbo_jpeg = False
+    return _turbo_jpeg or None
+
+
+def _decode_jpeg_turbo(path, flags):
+    """
+    以 libjpeg-turbo 直接解碼彩色 JPEG，省去 OpenCV 的格式偵測與 EXIF 處理
+    
+    只處理結果與 cv2.imread 相同的情況：灰階 JPEG，以及 IMREAD_COLOR 下
+    帶有 EXIF 旋轉標記的文件（OpenCV 會自動轉正）交回 OpenCV 解碼。
+    
+    Returns:
+        np.ndarray: BGR 圖像；不適用或解碼失敗時為 None
+    """
+    turbo_jpeg = _get_turbo_jpeg()
+    if turbo_jpeg is None or flags not in (cv2.IMREAD_COLOR, cv2.IMREAD_UNCHANGED):
+        return None
+    
+    try:
+        from turbojpeg import TJPF_BGR, TJCS_GRAY
+        
+        if flags == cv2.IMREAD_COLOR:
+            with Image.open(path) as im:
+                if im.getexif().get(EXIF_ORIENTATION_TAG, 1) != 1:
+                    return None
+        
+        with open(path, 'rb') as f:
+            jpeg_buf = f.read()
+        if turbo_jpeg.decode_header(jpeg_buf)[3] == TJCS_GRAY:
+            return None
+        return turbo_jpeg.decode(jpeg_buf, pixel_format=TJPF_BGR)
+    except Exception:
+        return None
+
+
+def _write_image(path, img):
+    """
+    編碼圖像後一次寫入文件，輸出格式由副檔名決定（與 cv2.imwrite 相同）
+    
+    輸出為 JPEG 且 PyTurboJPEG 可用時由 libjpeg-turbo 編碼，其餘使用 cv2.imencode；
+    編碼結果直接以 os.write 寫入暫存檔，不經過 Python 文件物件的緩衝，
+    寫完後才換到目標路徑（見 atomic_output）。
+    
+    Returns:
+        bool: 是否寫入成功
+    """
+    turbo_jpeg = _get_turbo_jpeg()
+    if (turbo_jpeg is not None and path.lower().endswith(JPEG_EXTENSIONS)
+            and img.dtype == np.uint8 and img.ndim == 3 and img.shape[2] == 3):
+        from turbojpeg import TJPF_BGR, TJSAMP_420
+        
+        buf = turbo_jpeg.encode(img, quality=JPEG_QUALITY, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+    else:
+        success, buf = cv2.imencode(os.path.splitext(path)[1], img)
+        if not success:
+            return False
+    
+    view = memoryview(buf).cast('B')
+    with atomic_output(path) as tmp_path:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+    return True
+
+
+_io_pool = None
+
+
+def _get_io_pool():
+    """apply_attack_async 的背景寫檔執行緒池（每個進程第一次使用時才建立；編碼與寫檔時 GIL 已釋放）"""
+    global _io_pool
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix='attack-writer')
+    return _io_pool
+
+
+def _reset_io_pool():
+    # fork 出的子進程（例如 CpuPool 的 worker）不會繼承父進程的執行緒，需重新建立
+    global _io_pool
+    _io_pool = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_io_pool)
+
+
+def _imread(path, flags=cv2.IMREAD_COLOR):
+    """
+    讀入整個文件後以 cv2.imdecode 解碼，結果與 cv2.imread(path, flags) 相同
+    
+    略過 imread 逐次讀取文件與格式偵測的額外開銷（JPEG 約快 5-10%），
+    Windows 上也能讀取含非 ASCII 字元的路徑。
+    
+    Returns:
+        np.ndarray: 圖像；無法讀取或解碼時為 None
+    """
+    try:
+        buf = np.fromfile(path, dtype=np.uint8)
+    except OSError:
+        return None
+    if buf.size == 0:
+        return None
+    return cv2.imdecode(buf, flags)
+
+
+# 已解碼圖像：(路徑, 旗標, 修改時間, 大小) -> 唯讀陣列，依最近使用排序
+_decode_cache = OrderedDict()
+_decode_cache_bytes = 0
+_decode_cache_lock = threading.Lock()
+
+
+def set_decode_cache_limit(max_bytes):
+    """
+    設定已解碼圖像快取的容量上限（位元組），0 表示停用並清空快取
+    
+    Args:
+        max_bytes (int): 容量上限
+    """
+    global DECODE_CACHE_MAX_BYTES
+    with _decode_cache_lock:
+        DECODE_CACHE_MAX_BYTES = max_bytes
+        _evict_decoded(0)
+
+
+def _evict_decoded(incoming_bytes):
+    """移除最久未使用的圖像，直到能再放入 incoming_bytes（需持有 _decode_cache_lock）"""
+    global _decode_cache_bytes
+    while _decode_cache and _decode_cache_bytes + incoming_bytes > DECODE_CACHE_MAX_BYTES:
+        _decode_cache_bytes -= _decode_cache.popitem(last=False)[1].nbytes
+
+
+def _decode_image(path, flags, mtime_ns, size):
+    """
+    解碼圖像文件，啟用快取時結果依位元組數上限保留（見 DECODE_CACHE_MAX_BYTES）
+    
+    快取鍵包含修改時間與大小，文件被覆寫後會重新解碼。
+    回傳的陣列可能在呼叫端之間共用，因此設為唯讀；需要修改時先複製。
+    
+    Returns:
+        np.ndarray: 圖像；無法讀取時為 None
+    """
+    global _decode_cache_bytes
+    key = (path, flags, mtime_ns, size)
+    if DECODE_CACHE_MAX_BYTES > 0:
+        with _decode_cache_lock:
+            img = _decode_cache.get(key)
+            if img is not None:
+                _decode_cache.move_to_end(key)
+                return img
+    
+    img = _decode_file(path, flags)
+    if img is not None and 0 < img.nbytes <= DECODE_CACHE_MAX_BYTES:
+        with _decode_cache_lock:
+            if key not in _decode_cache and img.nbytes <= DECODE_CACHE_MAX_BYTES:
+                _evict_decoded(img.nbytes)
+                _decode_cache[key] = img
+                _decode_cache_bytes += img.nbytes
+    return img
+
+
+def _decode_file(path, flags):
+    """
+    解碼圖像文件（不經過快取）
+    
+    Returns:
+        np.ndarray: 唯讀圖像；無法讀取時為 None
+    """
+    img = None
+    if path.lower().endswith(JPEG_EXTENSIONS):
+        img = _decode_jpeg_turbo(path, flags)
+    if img is None:
+        img = _imread(path, flags)
+    if img is not None:
+        img.flags.writeable = False
+    return img
+
+
+@lru_cache(maxsize=64)
+def _rotation_matrix(angle, rows, cols):
+    """繞圖像中心旋轉 angle 度的仿射矩陣（唯讀，同一角度與尺寸重複攻擊時共用）"""
+    matrix = cv2.getRotationMatrix2D(center=(cols / 2, rows / 2), angle=angle, scale=1)
+    matrix.flags.writeable = False
+    return matrix
+
+
+@lru_cache(maxsize=4)
+def _get_shufflers(password_img, block_num, block_size):
+    """
+    分塊內的亂序索引，與 random_strategy1 相同
+    
+    同一密碼與圖像尺寸的結果固定；大圖每次重新產生約需數十毫秒，因此快取共用（唯讀）。
+    """
+    shufflers = random_strategy1(password_img, block_num, block_size)
+    shufflers.flags.writeable = False
+    return shufflers
+
 
 class WatermarkService:
-    """浮水印服務統一介面"""
+    """
+    浮水印服務統一介面
+    
+    圖像前處理的順序：先縮小或裁剪，再做逐像素的轉換（cv2.cvtColor、亮度調整等），
+    讓轉換只處理縮小後的像素。例如縮放攻擊的 JPEG 輸入直接以縮小尺寸解碼
+    （_read_attack_input），裁剪攻擊先裁剪再縮放。
+    """
     
     def __init__(self, output_dir='output'):
         """
@@ -25,7 +320,24 @@ class WatermarkService:
         """
         self.output_dir = output_dir
         os.makedirs(output_dir, exist_ok=True)
-            logger.info(f"浮水印服務初始化完成，輸出目錄: {output_dir}")
+        
+        # 閒置的 WaterMark 實例，以 (password_img, password_wm) 為鍵重用
+        self._bwm_cache = {}
+        self._bwm_lock = threading.Lock()
+        
+        # warm_input_dir 預先掃描的輸入文件路徑（None 表示未啟用）
+        self._valid_inputs = None
+        
+        # 攻擊類型 -> 處理方法 (img, kwargs, full_size) -> 攻擊後的圖像
+        self._attacks = {
+            'cut': self._attack_cut,
+            'resize': self._attack_resize,
+            'bright': self._attack_bright,
+            'shelter': self._attack_shelter,
+            'salt_pepper': self._attack_salt_pepper,
+            'rot': self._attack_rot,
+        }
+        logger.info("浮水印服務初始化完成，輸出目錄: %s", output_dir)
     
     def embed_blind_watermark(self, input_path, output_path, watermark_text, 
                              password_img=1, password_wm=1):
@@ -48,53 +360,279 @@ class WatermarkService:
             Exception: 其他嵌入過程中的錯誤
         """
         try:
-            # 驗證輸入文件是否存在
-            if not os.path.exists(input_path):
-                raise FileNotFoundError(f"輸入圖像文件不存在: {input_path}")
+            # 驗證輸入文件是否存在（stat 結果沿用到解碼快取）
+            stat = self._stat_file(input_path, '輸入圖像文件')
             
             # 驗證浮水印文字
             if not watermark_text or not isinstance(watermark_text, str):
                 raise ValueError("浮水印文字必須是非空字符串")
             
-            # 驗證密碼參數
-            if not isinstance(password_img, int) or password_img < 1:
-                raise ValueError("圖像密碼必須是大於0的整數")
-            if not isinstance(password_wm, int) or password_wm < 1:
-                raise ValueError("浮水印密碼必須是大於0的整數")
+            self._validate_passwords(password_img, password_wm)
             
-            logger.info(f"開始嵌入浮水印: 輸入={input_path}, 輸出={output_path}, 浮水印長度={len(watermark_text)}")
+            logger.info("開始嵌入浮水印: 輸入=%s (%s bytes), 輸出=%s, 浮水印長度=%s", input_path, stat.st_size if stat is not None else '-', output_path, len(watermark_text))
             
-            # 創建 WaterMark 實例
-            bwm = WaterMark(password_img=password_img, password_wm=password_wm)
+            wm_length, = self._embed_file(input_path, stat, [(watermark_text, output_path)], 'str',
+                                          password_img, password_wm)
+            logger.info("浮水印位元長度: %s", wm_length)
             
-            # 讀取圖像
-            bwm.read_img(input_path)
-            logger.debug(f"圖像讀取成功: {input_path}")
+            return wm_length
             
-            # 讀取浮水印文字
-            bwm.read_wm(watermark_text, mode='str')
-            logger.debug(f"浮水印文字讀取成功，長度: {len(watermark_text)}")
+        except FileNotFoundError as e:
+            logger.error("文件未找到錯誤: %s", e)
+            raise
+        except ValueError as e:
+            logger.error("參數驗證錯誤: %s", e)
+            raise
+        except Exception as e:
+            logger.exception("嵌入浮水印時發生未知錯誤: %s", e)
+            raise Exception(f"嵌入浮水印失敗: {str(e)}")
+    
+    def embed_blind_watermark_bytes(self, input_path, output_path, wm_bytes, 
+                                    password_img=1, password_wm=1):
+        """
+        嵌入任意位元組的隱碼浮水印
+        
+        以 np.unpackbits 一次將位元組展開為位元陣列，每個位元組固定 8 位元
+        （文字模式會去掉開頭的 0 位元），以 extract_blind_watermark_bytes 取回。
+        
+        Args:
+            input_path (str): 輸入圖像路徑
+            output_path (str): 輸出圖像路徑
+            wm_bytes (bytes): 浮水印內容
+            password_img (int): 圖像密碼，用於加密圖像
+            password_wm (int): 浮水印密碼，用於加密浮水印
+        
+        Returns:
+            int: 浮水印位元長度，等於 len(wm_bytes) * 8
+        
+        Raises:
+            FileNotFoundError: 輸入圖像文件不存在
+            ValueError: 參數無效
+            Exception: 其他嵌入過程中的錯誤
+        """
+        try:
+            stat = self._stat_file(input_path, '輸入圖像文件')
+            
+            if not isinstance(wm_bytes, (bytes, bytearray, memoryview)) or not len(wm_bytes):
+                raise ValueError("浮水印內容必須是非空的位元組")
+            
+            self._validate_passwords(password_img, password_wm)
             
-            # 嵌入浮水印
-            bwm.embed(output_path)
-            logger.info(f"浮水印嵌入成功: {output_path}")
+            logger.info("開始嵌入浮水印: 輸入=%s (%s bytes), 輸出=%s, 浮水印位元組數=%s", input_path, stat.st_size if stat is not None else '-', output_path, len(wm_bytes))
             
-            # 獲取浮水印位元長度（提取時需要）
-            wm_length = len(bwm.wm_bit)
-            logger.info(f"浮水印位元長度: {wm_length}")
+            bits = np.unpackbits(np.frombuffer(wm_bytes, dtype=np.uint8)).astype(bool)
+            wm_length, = self._embed_file(input_path, stat, [(bits, output_path)], 'bit',
+                                          password_img, password_wm)
+            logger.info("浮水印位元長度: %s", wm_length)
             
             return wm_length
             
         except FileNotFoundError as e:
-            logger.error(f"文件未找到錯誤: {e}")
+            logger.error("文件未找到錯誤: %s", e)
+            raise
+        except ValueError as e:
+            logger.error("參數驗證錯誤: %s", e)
+            raise
+        except Exception as e:
+            logger.exception("嵌入浮水印時發生未知錯誤: %s", e)
+            raise Exception(f"嵌入浮水印失敗: {str(e)}")
+    
+    def embed_blind_watermark_batch(self, input_path, watermark_texts, output_paths, 
+                                    password_img=1, password_wm=1):
+        """
+        將多個文字浮水印分別嵌入同一張圖像（例如比較不同浮水印的魯棒性）
+        
+        圖像只解碼並做一次 YUV 轉換與 DWT，每個浮水印只重新執行
+        DCT/SVD 嵌入與逆 DWT，結果與逐一呼叫 embed_blind_watermark 相同。
+        
+        Args:
+            input_path (str): 輸入圖像路徑
+            watermark_texts (list): 浮水印文字列表
+            output_paths (list): 對應的輸出圖像路徑列表
+            password_img (int): 圖像密碼，用於加密圖像
+            password_wm (int): 浮水印密碼，用於加密浮水印
+        
+        Returns:
+            list: 各浮水印的位元長度
+        
+        Raises:
+            FileNotFoundError: 輸入圖像文件不存在
+            ValueError: 參數無效
+            Exception: 其他嵌入過程中的錯誤
+        """
+        try:
+            stat = self._stat_file(input_path, '輸入圖像文件')
+            
+            if len(watermark_texts) != len(output_paths):
+                raise ValueError("浮水印文字與輸出路徑的數量必須相同")
+            for watermark_text in watermark_texts:
+                if not watermark_text or not isinstance(watermark_text, str):
+                    raise ValueError("浮水印文字必須是非空字符串")
+            
+            self._validate_passwords(password_img, password_wm)
+            
+            logger.info("開始批次嵌入浮水印: 輸入=%s (%s bytes), 數量=%s", input_path, stat.st_size if stat is not None else '-', len(watermark_texts))
+            
+            return self._embed_file(input_path, stat, list(zip(watermark_texts, output_paths)), 'str',
+                                    password_img, password_wm)
+            
+        except FileNotFoundError as e:
+            logger.error("文件未找到錯誤: %s", e)
             raise
         except ValueError as e:
-            logger.error(f"參數驗證錯誤: {e}")
+            logger.error("參數驗證錯誤: %s", e)
             raise
         except Exception as e:
-            logger.error(f"嵌入浮水印時發生未知錯誤: {e}", exc_info=True)
+            logger.exception("嵌入浮水印時發生未知錯誤: %s", e)
             raise Exception(f"嵌入浮水印失敗: {str(e)}")
     
+    def _embed_file(self, input_path, stat, items, wm_mode, password_img, password_wm):
+        """
+        讀取圖像一次，依序嵌入每個浮水印並寫入對應的輸出文件
+        
+        _embed_image 不修改 bwm_core 中的 DWT 分塊，同一次讀取可重複嵌入。
+        
+        Args:
+            items (list): [(浮水印內容（傳給 bwm.read_wm）, 輸出路徑), ...]
+            wm_mode (str): 'str' 或 'bit'
+        
+        Returns:
+            list: 各浮水印的位元長度
+        """
+        wm_lengths = []
+        
+        # 取得 WaterMark 實例
+        with self._borrow_bwm(password_img, password_wm) as bwm:
+            # 讀取圖像（保留透明通道，與 bwm.read_img 相同）
+            img = self._decode(input_path, cv2.IMREAD_UNCHANGED, stat=stat)
+            if img is None:
+                raise ValueError(f"無法讀取圖像: {input_path}，請確認文件格式是否正確")
+            bwm.read_img(img=img)
+            logger.debug("圖像讀取成功: %s", input_path)
+            
+            for wm_content, output_path in items:
+                # 讀取浮水印（以 password_wm 打亂順序）
+                bwm.read_wm(wm_content, mode=wm_mode)
+                logger.debug("浮水印讀取成功，位元數: %s", bwm.wm_size)
+                
+                # 嵌入浮水印
+                embed_img = self._embed_image(bwm)
+                if not _write_image(output_path, embed_img):
+                    raise IOError(f"無法儲存嵌入浮水印後的圖像: {output_path}")
+                logger.info("浮水印嵌入成功: %s", output_path)
+                
+                # 獲取浮水印位元長度（提取時需要）
+                wm_lengths.append(len(bwm.wm_bit))
+        
+        return wm_lengths
+    
+    def _embed_image(self, bwm):
+        """
+        嵌入已讀取的浮水印，結果與 bwm.embed() 相同
+        
+        blind_watermark 對每個 4x4 分塊逐一呼叫 dct、svd、idct（Python 迴圈），
+        這裡改為一次對整個通道的所有分塊做批次 DCT、批次 SVD 與批次逆 DCT，
+        運算交由 numpy 的 LAPACK 批次實作；分塊、亂序與 DWT 沿用函式庫本身的資料。
+        
+        Returns:
+            np.ndarray: 嵌入浮水印後的 BGR（或 BGRA）圖像
+        """
+        core = bwm.bwm_core
+        core.init_block_index()
+        
+        rows, cols = core.ca_block_shape[:2]
+        block_num = core.block_num
+        block_size = core.block_shape[0] * core.block_shape[1]
+        shufflers = _get_shufflers(core.password_img, block_num, block_size)
+        dct4 = DCT4.astype(np.float32)
+        
+        # 第 i 個分塊嵌入 wm_bit[i % wm_size]
+        wm_1 = core.wm_bit[np.arange(block_num) % core.wm_size].astype(np.float32)
+        
+        embed_YUV = []
+        for channel in range(3):
+            blocks = core.ca_block[channel].reshape(block_num, *core.block_shape)
+            block_dct = dct4 @ blocks @ dct4.T
+            shuffled = np.take_along_axis(block_dct.reshape(block_num, block_size), shufflers, axis=1)
+            u, s, v = np.linalg.svd(shuffled.reshape(blocks.shape))
+            
+            s[:, 0] = (s[:, 0] // core.d1 + 1 / 4 + 1 / 2 * wm_1) * core.d1
+            if core.d2:
+                s[:, 1] = (s[:, 1] // core.d2 + 1 / 4 + 1 / 2 * wm_1) * core.d2
+            
+            # 逆 SVD -> 還原亂序 -> 逆 DCT
+            restored = np.empty((block_num, block_size), dtype=np.float32)
+            np.put_along_axis(restored, shufflers, ((u * s[:, None, :]) @ v).reshape(block_num, block_size), axis=1)
+            embedded = dct4.T @ restored.reshape(blocks.shape) @ dct4
+            
+            # 4 維分塊變回 2 維，右邊和下邊不能整除的長條保留原值
+            embed_ca = core.ca[channel].copy()
+            embed_ca[:rows * core.block_shape[0], :cols * core.block_shape[1]] = \
+                embedded.reshape(rows, cols, *core.block_shape).transpose(0, 2, 1, 3).reshape(core.part_shape)
+            embed_YUV.append(idwt2((embed_ca, core.hvd[channel]), 'haar'))
+        
+        # 合併 3 通道，去除讀取時為補成偶數尺寸加上的白邊
+        embed_img_YUV = np.stack(embed_YUV, axis=2)[:core.img_shape[0], :core.img_shape[1]]
+        embed_img = np.clip(cv2.cvtColor(embed_img_YUV, cv2.COLOR_YUV2BGR), a_min=0, a_max=255)
+        
+        if core.alpha is not None:
+            embed_img = cv2.merge([embed_img.astype(np.uint8), core.alpha])
+        return embed_img
+    
+    def get_wm_length(self, watermark_text):
+        """
+        計算文字浮水印的位元長度（與 embed_blind_watermark 的回傳值一致）
+        
+        只轉換浮水印文字，不讀取圖像，用於重用已嵌入的輸出時回傳 wm_length。
+        
+        Args:
+            watermark_text (str): 浮水印文字
+        
+        Returns:
+            int: 浮水印位元長度
+        """
+        with self._borrow_bwm(1, 1) as bwm:
+            bwm.read_wm(watermark_text, mode='str')
+            return len(bwm.wm_bit)
+    
+    @contextmanager
+    def _borrow_bwm(self, password_img, password_wm):
+        """
+        借用一個 WaterMark 實例，用完後清除圖像與浮水印狀態並放回快取
+        
+        借出期間實例從快取中移除，同時處理相同密碼的請求會各自使用不同實例。
+        """
+        key = (password_img, password_wm)
+        with self._bwm_lock:
+            idle = self._bwm_cache.get(key)
+            bwm = idle.pop() if idle else None
+        
+        if bwm is None:
+            _load_blind_watermark()
+            bwm = WaterMark(password_img=password_img, password_wm=password_wm)
+        
+        try:
+            yield bwm
+        finally:
+            self._reset_bwm(bwm)
+            with self._bwm_lock:
+                if key in self._bwm_cache or len(self._bwm_cache) < BWM_CACHE_MAX_KEYS:
+                    self._bwm_cache.setdefault(key, []).append(bwm)
+    
+    def _reset_bwm(self, bwm):
+        """清除 WaterMark 實例中上一次使用的圖像與浮水印（釋放大型陣列）"""
+        bwm.wm_bit = None
+        bwm.wm_size = 0
+        
+        core = bwm.bwm_core
+        core.img = core.img_YUV = core.alpha = None
+        core.ca, core.hvd = [np.array([])] * 3, [np.array([])] * 3
+        core.ca_block = [np.array([])] * 3
+        core.ca_part = [np.array([])] * 3
+        core.wm_size = core.block_num = 0
+        core.wm_bit = None
+        core.block_index = None
+    
     def extract_blind_watermark(self, input_path, wm_length, 
                                 password_img=1, password_wm=1):
         """
@@ -115,49 +653,284 @@ class WatermarkService:
             Exception: 其他提取過程中的錯誤
         """
         try:
-            # 驗證輸入文件是否存在
-            if not os.path.exists(input_path):
-                raise FileNotFoundError(f"輸入圖像文件不存在: {input_path}")
-            
-            # 驗證浮水印長度
-            if not isinstance(wm_length, int) or wm_length <= 0:
-                raise ValueError("浮水印長度必須是大於0的整數")
+            extracted_text = self._bits_to_text(
+                self._extract_file(input_path, wm_length, password_img, password_wm)
+            )
             
-            # 驗證密碼參數
-            if not isinstance(password_img, int) or password_img < 1:
-                raise ValueError("圖像密碼必須是大於0的整數")
-            if not isinstance(password_wm, int) or password_wm < 1:
-                raise ValueError("浮水印密碼必須是大於0的整數")
+            logger.info("浮水印提取成功，提取長度: %s", len(extracted_text) if extracted_text else 0)
             
-            logger.info(f"開始提取浮水印: 輸入={input_path}, 浮水印長度={wm_length}")
+            return extracted_text
             
-            # 創建 WaterMark 實例（必須使用與嵌入時相同的密碼）
-            bwm = WaterMark(password_img=password_img, password_wm=password_wm)
+        except FileNotFoundError as e:
+            logger.error("文件未找到錯誤: %s", e)
+            raise
+        except ValueError as e:
+            logger.error("參數驗證錯誤: %s", e)
+            raise
+        except Exception as e:
+            logger.exception("提取浮水印時發生未知錯誤: %s", e)
+            raise Exception(f"提取浮水印失敗: {str(e)}")
+    
+    def extract_blind_watermark_bytes(self, input_path, wm_length, 
+                                      password_img=1, password_wm=1):
+        """
+        提取以 embed_blind_watermark_bytes 嵌入的位元組浮水印
+        
+        Args:
+            input_path (str): 帶浮水印的圖像路徑
+            wm_length (int): 浮水印位元長度（必須與嵌入時一致，為 8 的倍數）
+            password_img (int): 圖像密碼（必須與嵌入時一致）
+            password_wm (int): 浮水印密碼（必須與嵌入時一致）
+        
+        Returns:
+            bytes: 提取的浮水印內容
+        
+        Raises:
+            FileNotFoundError: 輸入圖像文件不存在
+            ValueError: 參數無效
+            Exception: 其他提取過程中的錯誤
+        """
+        try:
+            if isinstance(wm_length, int) and wm_length % 8:
+                raise ValueError("位元組浮水印的長度必須是 8 的倍數")
             
-            # 提取浮水印
-            extracted_text = bwm.extract(
-                filename=input_path,
-                wm_shape=wm_length,
-                mode='str'
-            )
+            wm = self._extract_file(input_path, wm_length, password_img, password_wm)
+            extracted = np.packbits(wm >= 0.5).tobytes()
             
-            logger.info(f"浮水印提取成功，提取長度: {len(extracted_text) if extracted_text else 0}")
+            logger.info("浮水印提取成功，提取位元組數: %s", len(extracted))
             
-            return extracted_text
+            return extracted
             
         except FileNotFoundError as e:
-            logger.error(f"文件未找到錯誤: {e}")
+            logger.error("文件未找到錯誤: %s", e)
             raise
         except ValueError as e:
-            logger.error(f"參數驗證錯誤: {e}")
+            logger.error("參數驗證錯誤: %s", e)
+            raise
+        except Exception as e:
+            logger.exception("提取浮水印時發生未知錯誤: %s", e)
+            raise Exception(f"提取浮水印失敗: {str(e)}")
+    
+    def _extract_file(self, input_path, wm_length, password_img, password_wm):
+        """
+        驗證參數、讀取圖像並提取解密後的浮水印位元
+        
+        Returns:
+            np.ndarray: 每個浮水印位元的判定結果
+        """
+        # 驗證輸入文件是否存在（stat 結果沿用到解碼快取）
+        stat = self._stat_file(input_path, '輸入圖像文件')
+        
+        self._validate_extract_params(wm_length, password_img, password_wm)
+        
+        logger.info("開始提取浮水印: 輸入=%s (%s bytes), 浮水印長度=%s", input_path, stat.st_size if stat is not None else '-', wm_length)
+        
+        img = self._decode(input_path, stat=stat)
+        if img is None:
+            raise ValueError(f"無法讀取圖像: {input_path}，請確認文件格式是否正確")
+        
+        # 取得 WaterMark 實例（必須使用與嵌入時相同的密碼）並提取浮水印
+        with self._borrow_bwm(password_img, password_wm) as bwm:
+            return self._extract_bits(bwm, img, wm_length)
+    
+    def extract_blind_watermark_inmem(self, input_arr, wm_length, 
+                                      password_img=1, password_wm=1):
+        """
+        從記憶體中的圖像提取隱碼浮水印
+        
+        與 extract_blind_watermark 相同，但直接接收 BGR 陣列（例如 apply_attack_inmem
+        的結果），省去寫入與重新讀取圖像文件。
+        
+        Args:
+            input_arr (np.ndarray): 帶浮水印的 BGR 圖像
+            wm_length (int): 浮水印位元長度（必須與嵌入時一致）
+            password_img (int): 圖像密碼（必須與嵌入時一致）
+            password_wm (int): 浮水印密碼（必須與嵌入時一致）
+        
+        Returns:
+            str: 提取的浮水印文字
+        
+        Raises:
+            ValueError: 參數無效
+            Exception: 其他提取過程中的錯誤
+        """
+        try:
+            if not isinstance(input_arr, np.ndarray) or input_arr.ndim != 3 or input_arr.shape[2] != 3:
+                raise ValueError("輸入圖像必須是 (height, width, 3) 的 BGR 陣列")
+            
+            self._validate_extract_params(wm_length, password_img, password_wm)
+            
+            with self._borrow_bwm(password_img, password_wm) as bwm:
+                return self._bits_to_text(self._extract_bits(bwm, input_arr, wm_length))
+            
+        except ValueError as e:
+            logger.error("參數驗證錯誤: %s", e)
             raise
         except Exception as e:
-            logger.error(f"提取浮水印時發生未知錯誤: {e}", exc_info=True)
+            logger.exception("提取浮水印時發生未知錯誤: %s", e)
             raise Exception(f"提取浮水印失敗: {str(e)}")
     
+    def _validate_extract_params(self, wm_length, password_img, password_wm):
+        """驗證提取浮水印的長度與密碼參數"""
+        # 驗證浮水印長度
+        if not isinstance(wm_length, int) or wm_length <= 0:
+            raise ValueError("浮水印長度必須是大於0的整數")
+        
+        self._validate_passwords(password_img, password_wm)
+    
+    def _validate_passwords(self, password_img, password_wm):
+        """驗證密碼參數"""
+        if not isinstance(password_img, int) or password_img < 1:
+            raise ValueError("圖像密碼必須是大於0的整數")
+        if not isinstance(password_wm, int) or password_wm < 1:
+            raise ValueError("浮水印密碼必須是大於0的整數")
+    
+    def _extract_bits(self, bwm, img, wm_length):
+        """
+        提取浮水印位元，結果與 bwm.extract(embed_img=img, wm_shape=wm_length, mode='bit') 相同
+        
+        blind_watermark 對每個 4x4 分塊逐一呼叫 dct 與 svd（Python 迴圈），
+        這裡改為一次對整個通道的所有分塊做批次 DCT 與批次 SVD，
+        其餘步驟（分塊、亂序、平均、k-means、解密）沿用函式庫本身的實作。
+        """
+        core = bwm.bwm_core
+        bwm.wm_size = core.wm_size = wm_length
+        core.read_img_arr(img=img)
+        
+        rows, cols = core.ca_block_shape[:2]
+        block_num = rows * cols
+        if wm_length >= block_num:
+            raise ValueError(f"浮水印長度 {wm_length} 超過圖像可容納的 {block_num} 位元")
+        
+        block_size = core.block_shape[0] * core.block_shape[1]
+        shufflers = _get_shufflers(core.password_img, block_num, block_size)
+        dct4 = DCT4.astype(np.float32)
+        
+        # 每個通道、每個分塊提取 1 bit
+        wm_block_bit = np.empty((3, block_num), dtype=np.float32)
+        for channel in range(3):
+            blocks = core.ca_block[channel].reshape(block_num, *core.block_shape)
+            block_dct = dct4 @ blocks @ dct4.T
+            shuffled = np.take_along_axis(block_dct.reshape(block_num, block_size), shufflers, axis=1)
+            s = np.linalg.svd(shuffled.reshape(blocks.shape), compute_uv=False)
+            
+            wm = (s[:, 0] % core.d1 > core.d1 / 2) * 1
+            if core.d2:
+                wm = (wm * 3 + (s[:, 1] % core.d2 > core.d2 / 2) * 1) / 4
+            wm_block_bit[channel] = wm
+        
+        # 循環嵌入 + 3 個通道求平均，分群後解密
+        wm_avg = core.extract_avg(wm_block_bit)
+        return bwm.extract_decrypt(wm_avg=one_dim_kmeans(wm_avg))
+    
+    def _bits_to_text(self, wm):
+        """將提取的位元轉為文字（與 blind_watermark 的 mode='str' 相同）"""
+        byte = ''.join(str((i >= 0.5) * 1) for i in wm)
+        return bytes.fromhex(hex(int(byte, base=2))[2:]).decode('utf-8', errors='replace')
+    
     def apply_attack(self, input_path, output_path, attack_type, **kwargs):
         """
-        應用攻擊測試
+        應用攻擊測試，讀取輸入圖像並將攻擊後的圖像寫入文件
+        
+        攻擊本身由 apply_attack_inmem 的同一實作完成，參數說明見 apply_attack_inmem。
+        
+        Args:
+            input_path (str): 輸入圖像路徑（帶浮水印的圖像）
+            output_path (str): 輸出圖像路徑（攻擊後的圖像）
+            attack_type (str): 攻擊類型
+            **kwargs: 攻擊參數
+        
+        Returns:
+            str: 輸出圖像路徑
+        
+        Raises:
+            FileNotFoundError: 輸入圖像文件不存在
+            ValueError: 攻擊類型不支援或參數無效
+            Exception: 其他攻擊過程中的錯誤
+        """
+        try:
+            attacked_img = self._attack_file(input_path, output_path, attack_type, kwargs)
+            
+            # 儲存攻擊後的圖像
+            return self._write_attack_output(output_path, attacked_img)
+            
+        except FileNotFoundError as e:
+            logger.error("文件未找到錯誤: %s", e)
+            raise
+        except ValueError as e:
+            logger.error("參數驗證錯誤: %s", e)
+            raise
+        except Exception as e:
+            logger.exception("應用攻擊時發生未知錯誤: %s", e)
+            raise Exception(f"應用攻擊失敗: {str(e)}")
+    
+    def apply_attack_async(self, input_path, output_path, attack_type, **kwargs):
+        """
+        應用攻擊測試，攻擊完成後交由背景執行緒寫入文件
+        
+        攻擊本身在呼叫端執行緒同步完成（參數錯誤會立即拋出），
+        輸出圖像的編碼與寫檔則與下一次攻擊的解碼與運算重疊，
+        適合對同一張圖像連續套用多種攻擊。若要以輸出作為下一次攻擊的輸入，
+        須先等待對應的 Future 完成。
+        
+        Args:
+            input_path (str): 輸入圖像路徑（帶浮水印的圖像）
+            output_path (str): 輸出圖像路徑（攻擊後的圖像）
+            attack_type (str): 攻擊類型
+            **kwargs: 攻擊參數（見 apply_attack_inmem）
+        
+        Returns:
+            tuple: (輸出圖像路徑, Future)，Future.result() 在寫入完成後回傳輸出路徑，
+                寫入失敗時拋出 IOError
+        
+        Raises:
+            FileNotFoundError: 輸入圖像文件不存在
+            ValueError: 攻擊類型不支援或參數無效
+            Exception: 其他攻擊過程中的錯誤
+        """
+        try:
+            attacked_img = self._attack_file(input_path, output_path, attack_type, kwargs)
+            
+            # 背景寫入攻擊後的圖像
+            return output_path, _get_io_pool().submit(self._write_attack_output, output_path, attacked_img)
+            
+        except FileNotFoundError as e:
+            logger.error("文件未找到錯誤: %s", e)
+            raise
+        except ValueError as e:
+            logger.error("參數驗證錯誤: %s", e)
+            raise
+        except Exception as e:
+            logger.exception("應用攻擊時發生未知錯誤: %s", e)
+            raise Exception(f"應用攻擊失敗: {str(e)}")
+    
+    def _attack_file(self, input_path, output_path, attack_type, kwargs):
+        """讀取輸入圖像並應用攻擊（apply_attack 與 apply_attack_async 共用），回傳攻擊後的圖像"""
+        # 驗證輸入文件是否存在（stat 結果沿用到解碼快取）
+        stat = self._stat_file(input_path, '輸入圖像文件')
+        
+        # 讀取圖像（縮小類攻擊的 JPEG 直接以縮小尺寸解碼）
+        img, factor, full_size = self._read_attack_input(input_path, attack_type, kwargs, stat)
+        if img is None:
+            raise ValueError(f"無法讀取圖像: {input_path}，請確認文件格式是否正確")
+        
+        logger.info("開始應用攻擊: 類型=%s, 輸入=%s (%s bytes), 輸出=%s", attack_type, input_path, stat.st_size if stat is not None else '-', output_path)
+        return self._attack_array(img, attack_type, kwargs, full_size if factor > 1 else None)
+    
+    def _write_attack_output(self, output_path, attacked_img):
+        """寫入攻擊後的圖像，回傳輸出路徑"""
+        if not _write_image(output_path, attacked_img):
+            raise IOError(f"無法儲存攻擊後的圖像: {output_path}")
+        
+        logger.info("攻擊測試完成: %s", output_path)
+        return output_path
+    
+    def apply_attack_inmem(self, input_arr, attack_type, **kwargs):
+        """
+        對記憶體中的圖像應用攻擊測試
+        
+        直接接收並回傳 BGR 陣列，攻擊後接著提取浮水印時（搭配
+        extract_blind_watermark_inmem）可省去一次圖像編碼、寫檔與解碼。
         
         支援的攻擊類型:
         - 'cut': 裁剪+縮放攻擊 (cut_att3)
@@ -168,122 +941,312 @@ class WatermarkService:
         - 'rot': 旋轉攻擊 (rot_att)
         
         Args:
-            input_path (str): 輸入圖像路徑（帶浮水印的圖像）
-            output_path (str): 輸出圖像路徑（攻擊後的圖像）
+            input_arr (np.ndarray): 輸入 BGR 圖像（帶浮水印的圖像）
             attack_type (str): 攻擊類型
             **kwargs: 攻擊參數
                 - cut: loc_r (tuple), loc (tuple), scale (float)
-                - resize: out_shape (tuple)
+                - resize: out_shape (tuple), interpolation ('linear'、'area' 或 'nearest'，預設 'linear')
                 - bright: ratio (float)
                 - shelter: ratio (float), n (int)
                 - salt_pepper: ratio (float)
-                - rot: angle (float)
+                - rot: angle (float), interpolation ('linear' 或 'nearest'，預設 'linear')
         
         Returns:
-            str: 輸出圖像路徑
+            np.ndarray: 攻擊後的 BGR 圖像
         
         Raises:
-            FileNotFoundError: 輸入圖像文件不存在
             ValueError: 攻擊類型不支援或參數無效
             Exception: 其他攻擊過程中的錯誤
         """
         try:
-            # 驗證輸入文件是否存在
-            if not os.path.exists(input_path):
-                raise FileNotFoundError(f"輸入圖像文件不存在: {input_path}")
-            
-            # 讀取圖像
-            img = cv2.imread(input_path)
-            if img is None:
-                raise ValueError(f"無法讀取圖像: {input_path}，請確認文件格式是否正確")
-            
-            logger.info(f"開始應用攻擊: 類型={attack_type}, 輸入={input_path}, 輸出={output_path}")
+            if not isinstance(input_arr, np.ndarray) or input_arr.size == 0:
+                raise ValueError("輸入圖像必須是非空的 numpy 陣列")
             
-            # 根據攻擊類型應用不同的攻擊
-            if attack_type == 'cut':
-                # 裁剪+縮放攻擊 (cut_att3)
-                loc_r = kwargs.get('loc_r', None)
-                loc = kwargs.get('loc', None)
-                scale = kwargs.get('scale', None)
-                
-                logger.debug(f"裁剪+縮放參數: loc_r={loc_r}, loc={loc}, scale={scale}")
-                attacked_img = att.cut_att3(input_img=img, loc_r=loc_r, loc=loc, scale=scale)
-                
-            elif attack_type == 'resize':
-                # 縮放攻擊 (resize_att)
-                out_shape = kwargs.get('out_shape', (500, 500))
-                if not isinstance(out_shape, (tuple, list)) or len(out_shape) != 2:
-                    raise ValueError("out_shape 必須是包含兩個元素的元組或列表 (width, height)")
-                
-                logger.debug(f"縮放參數: out_shape={out_shape}")
-                attacked_img = att.resize_att(input_img=img, out_shape=out_shape)
-                
-            elif attack_type == 'bright':
-                # 亮度調整攻擊 (bright_att)
-                ratio = kwargs.get('ratio', 0.8)
-                if not isinstance(ratio, (int, float)) or ratio <= 0:
-                    raise ValueError("亮度比例必須是大於0的數值")
-                
-                logger.debug(f"亮度調整參數: ratio={ratio}")
-                attacked_img = att.bright_att(input_img=img, ratio=ratio)
-                
-            elif attack_type == 'shelter':
-                # 遮擋攻擊 (shelter_att)
-                ratio = kwargs.get('ratio', 0.1)
-                n = kwargs.get('n', 3)
-                
-                if not isinstance(ratio, (int, float)) or ratio <= 0 or ratio > 1:
-                    raise ValueError("遮擋比例必須是0到1之間的數值")
-                if not isinstance(n, int) or n < 1:
-                    raise ValueError("遮擋塊數量必須是大於0的整數")
-                
-                logger.debug(f"遮擋參數: ratio={ratio}, n={n}")
-                attacked_img = att.shelter_att(input_img=img, ratio=ratio, n=n)
-                
-            elif attack_type == 'salt_pepper':
-                # 椒鹽噪聲攻擊 (salt_pepper_att)
-                ratio = kwargs.get('ratio', 0.01)
-                if not isinstance(ratio, (int, float)) or ratio <= 0 or ratio > 1:
-                    raise ValueError("噪聲比例必須是0到1之間的數值")
-                
-                logger.debug(f"椒鹽噪聲參數: ratio={ratio}")
-                attacked_img = att.salt_pepper_att(input_img=img, ratio=ratio)
-                
-            elif attack_type == 'rot':
-                # 旋轉攻擊 (rot_att)
-                angle = kwargs.get('angle', 45)
-                if not isinstance(angle, (int, float)):
-                    raise ValueError("旋轉角度必須是數值")
-                
-                logger.debug(f"旋轉參數: angle={angle}")
-                attacked_img = att.rot_att(input_img=img, angle=angle)
-                
-            else:
-                raise ValueError(f"不支援的攻擊類型: {attack_type}。支援的類型: cut, resize, bright, shelter, salt_pepper, rot")
-            
-            # 驗證攻擊後的圖像
-            if attacked_img is None or attacked_img.size == 0:
-                raise ValueError(f"攻擊後圖像為空，攻擊類型: {attack_type}")
+            logger.info("開始應用攻擊: 類型=%s, 輸入為記憶體圖像 %s", attack_type, input_arr.shape)
+            return self._attack_array(input_arr, attack_type, kwargs)
             
-            # 儲存攻擊後的圖像
-            success = cv2.imwrite(output_path, attacked_img)
-            if not success:
-                raise IOError(f"無法儲存攻擊後的圖像: {output_path}")
-            
-            logger.info(f"攻擊測試完成: {output_path}")
-            
-            return output_path
-            
-        except FileNotFoundError as e:
-            logger.error(f"文件未找到錯誤: {e}")
-            raise
         except ValueError as e:
-            logger.error(f"參數驗證錯誤: {e}")
+            logger.error("參數驗證錯誤: %s", e)
             raise
         except Exception as e:
-            logger.error(f"應用攻擊時發生未知錯誤: {e}", exc_info=True)
+            logger.exception("應用攻擊時發生未知錯誤: %s", e)
             raise Exception(f"應用攻擊失敗: {str(e)}")
     
+    def _attack_array(self, img, attack_type, kwargs, full_size=None):
+        """
+        依攻擊類型對圖像陣列應用攻擊
+        
+        Args:
+            full_size (tuple): img 為縮小解碼的結果時，原始圖像尺寸 (width, height)
+        
+        Returns:
+            np.ndarray: 攻擊後的圖像
+        """
+        attack = self._attacks.get(attack_type)
+        if attack is None:
+            raise ValueError(f"不支援的攻擊類型: {attack_type}。支援的類型: {', '.join(self._attacks)}")
+        
+        _load_blind_watermark()
+        attacked_img = attack(img, kwargs, full_size)
+        
+        # 驗證攻擊後的圖像
+        if attacked_img is None or attacked_img.size == 0:
+            raise ValueError(f"攻擊後圖像為空，攻擊類型: {attack_type}")
+        
+        return attacked_img
+    
+    def _attack_cut(self, img, kwargs, full_size):
+        """裁剪+縮放攻擊 (cut_att3)"""
+        loc_r = kwargs.get('loc_r', None)
+        loc = kwargs.get('loc', None)
+        scale = kwargs.get('scale', None)
+        
+        logger.debug("裁剪+縮放參數: loc_r=%s, loc=%s, scale=%s", loc_r, loc, scale)
+        if full_size is not None:
+            # 以原始尺寸計算輸出大小，結果尺寸與完整解碼時一致
+            width, height = full_size
+            crop_w = int(width * loc_r[1][0]) - int(width * loc_r[0][0])
+            crop_h = int(height * loc_r[1][1]) - int(height * loc_r[0][1])
+            cropped = att.cut_att3(input_img=img, loc_r=loc_r)
+            return cv2.resize(cropped, dsize=(round(crop_w * scale), round(crop_h * scale)))
+        return att.cut_att3(input_img=img, loc_r=loc_r, loc=loc, scale=scale)
+    
+    def _attack_resize(self, img, kwargs, full_size):
+        """縮放攻擊 (resize_att)"""
+        out_shape = kwargs.get('out_shape', (500, 500))
+        if not isinstance(out_shape, (tuple, list)) or len(out_shape) != 2:
+            raise ValueError("out_shape 必須是包含兩個元素的元組或列表 (width, height)")
+        
+        interpolation = kwargs.get('interpolation', 'linear')
+        if interpolation not in RESIZE_INTERPOLATIONS:
+            raise ValueError(f"縮放插值方式必須是: {', '.join(RESIZE_INTERPOLATIONS)}")
+        
+        logger.debug("縮放參數: out_shape=%s, interpolation=%s", out_shape, interpolation)
+        # 直接對 uint8 圖像縮放（預設 INTER_LINEAR，與 att.resize_att 相同）
+        return cv2.resize(img, dsize=(int(out_shape[0]), int(out_shape[1])),
+                          interpolation=RESIZE_INTERPOLATIONS[interpolation])
+    
+    def _attack_bright(self, img, kwargs, full_size):
+        """亮度調整攻擊 (bright_att)"""
+        ratio = kwargs.get('ratio', 0.8)
+        if not isinstance(ratio, (int, float)) or ratio <= 0:
+            raise ValueError("亮度比例必須是大於0的數值")
+        
+        logger.debug("亮度調整參數: ratio=%s", ratio)
+        # 一次完成相乘、四捨五入與飽和到 0-255（att.bright_att 會產生 float64 中間陣列）
+        return cv2.convertScaleAbs(img, alpha=float(ratio), beta=0.0)
+    
+    def _attack_shelter(self, img, kwargs, full_size):
+        """遮擋攻擊 (shelter_att)"""
+        ratio = kwargs.get('ratio', 0.1)
+        n = kwargs.get('n', 3)
+        
+        if not isinstance(ratio, (int, float)) or ratio <= 0 or ratio > 1:
+            raise ValueError("遮擋比例必須是0到1之間的數值")
+        if not isinstance(n, int) or n < 1:
+            raise ValueError("遮擋塊數量必須是大於0的整數")
+        
+        logger.debug("遮擋參數: ratio=%s, n=%s", ratio, n)
+        return att.shelter_att(input_img=img, ratio=ratio, n=n)
+    
+    def _attack_salt_pepper(self, img, kwargs, full_size):
+        """椒鹽噪聲攻擊 (salt_pepper_att)"""
+        ratio = kwargs.get('ratio', 0.01)
+        if not isinstance(ratio, (int, float)) or ratio <= 0 or ratio > 1:
+            raise ValueError("噪聲比例必須是0到1之間的數值")
+        
+        logger.debug("椒鹽噪聲參數: ratio=%s", ratio)
+        return self._salt_pepper_fast(img, ratio)
+    
+    def _attack_rot(self, img, kwargs, full_size):
+        """旋轉攻擊 (rot_att)"""
+        angle = kwargs.get('angle', 45)
+        if not isinstance(angle, (int, float)):
+            raise ValueError("旋轉角度必須是數值")
+        
+        interpolation = kwargs.get('interpolation', 'linear')
+        if interpolation not in ROT_INTERPOLATIONS:
+            raise ValueError(f"旋轉插值方式必須是: {', '.join(ROT_INTERPOLATIONS)}")
+        
+        logger.debug("旋轉參數: angle=%s, interpolation=%s", angle, interpolation)
+        # 與 att.rot_att 相同：繞圖像中心旋轉、保持原尺寸，旋轉矩陣依角度與尺寸快取
+        rows, cols = img.shape[:2]
+        return cv2.warpAffine(img, _rotation_matrix(float(angle), rows, cols), (cols, rows),
+                              flags=ROT_INTERPOLATIONS[interpolation])
+    
+    def _salt_pepper_fast(self, img, ratio):
+        """
+        椒鹽噪聲攻擊，結果與 att.salt_pepper_att 相同
+        
+        att.salt_pepper_att 逐像素呼叫 np.random.rand()；這裡一次產生整張遮罩，
+        依相同順序取用全域亂數，因此相同亂數種子下被設為 255 的像素也相同。
+        """
+        output_img = img.copy()
+        output_img[np.random.rand(*img.shape[:2]) < ratio] = 255
+        return output_img
+    
+    def _read_attack_input(self, input_path, attack_type, params, stat=None):
+        """
+        讀取攻擊輸入圖像
+        
+        縮放攻擊與縮小的裁剪攻擊最終只需要較小的圖像；輸入為 JPEG 時以
+        IMREAD_REDUCED_COLOR_* 讓解碼器直接輸出 1/2、1/4 或 1/8 尺寸，
+        省去完整解碼。其他情況照常完整讀取。
+        
+        Returns:
+            tuple: (圖像, 縮小倍數, 原始尺寸 (width, height))；未縮小時倍數為 1，原始尺寸為 None
+        """
+        min_size = None
+        if attack_type == 'resize':
+            out_shape = params.get('out_shape', (500, 500))
+            if isinstance(out_shape, (tuple, list)) and len(out_shape) == 2:
+                min_size = out_shape
+        elif attack_type == 'cut':
+            scale = params.get('scale')
+            if params.get('loc') is None and params.get('loc_r') is not None and scale and 0 < scale < 1:
+                min_size = scale
+        
+        full_size = self._probe_jpeg_size(input_path) if min_size is not None else None
+        if full_size is not None:
+            width, height = full_size
+            if not isinstance(min_size, (tuple, list)):
+                min_size = (width * min_size, height * min_size)
+            
+            for factor, flag in REDUCED_READ_FLAGS:
+                if width // factor >= min_size[0] and height // factor >= min_size[1]:
+                    img = _imread(input_path, flag)
+                    if img is not None and img.shape[1] >= min_size[0] and img.shape[0] >= min_size[1]:
+                        return img, factor, full_size
+                    break
+        
+        return self._decode(input_path, stat=stat), 1, None
+    
+    def warm_input_dir(self, root):
+        """
+        預先掃描輸入目錄，之後對其中文件的存在檢查不再呼叫 os.stat
+        
+        用於從固定目錄（例如 NFS/Lustre 上的資料集）批次處理大量圖像的情境，
+        每次 stat 都是一次網路往返。只記錄路徑，不記錄大小與修改時間：
+        文件被覆寫後照常讀取新內容（啟用解碼快取時仍以 os.stat 取得快取鍵），
+        被刪除時讀取失敗並拋出 FileNotFoundError。再次呼叫會重新掃描。
+        查表以呼叫端傳入的路徑字串比對，路徑格式須與 os.path.join(root, ...) 相同。
+        
+        Args:
+            root (str): 輸入目錄路徑
+        
+        Returns:
+            int: 掃描到的文件數量
+        """
+        paths = set()
+        pending = [root]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        paths.add(entry.path)
+        
+        self._valid_inputs = paths
+        logger.info("輸入目錄掃描完成: %s, 文件數=%s", root, len(paths))
+        return len(paths)
+    
+    def _stat_file(self, path, description):
+        """
+        確認文件存在並回傳 os.stat 結果（一次系統呼叫同時完成存在檢查與取得大小、修改時間）
+        
+        路徑在 warm_input_dir 的掃描結果中時不呼叫 os.stat，回傳 None
+        （_decode 在讀取失敗時才確認文件是否仍存在）。
+        
+        Raises:
+            FileNotFoundError: 文件不存在
+        """
+        valid_inputs = self._valid_inputs
+        if valid_inputs is not None and path in valid_inputs:
+            return None
+        
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"{description}不存在: {path}")
+    
+    def _decode(self, input_path, flags=cv2.IMREAD_COLOR, stat=None):
+        """
+        讀取圖像，啟用解碼快取時結果依 (路徑, 旗標, 修改時間, 大小) 快取
+        
+        批次腳本中嵌入後立即攻擊、攻擊後提取等流程會重複讀取同一文件，
+        以 set_decode_cache_limit 啟用快取後只解碼一次。
+        回傳的陣列為唯讀，不可直接修改。
+        
+        Args:
+            stat (os.stat_result): 呼叫端已取得的 stat 結果，避免重複 stat；
+                None 時只在啟用解碼快取時才 stat（取得快取鍵）
+        
+        Returns:
+            np.ndarray: 圖像；無法解碼時為 None
+        
+        Raises:
+            FileNotFoundError: 文件不存在
+        """
+        if stat is None and DECODE_CACHE_MAX_BYTES > 0:
+            try:
+                stat = os.stat(input_path)
+            except FileNotFoundError:
+                raise FileNotFoundError(f"輸入圖像文件不存在: {input_path}")
+        
+        if stat is None:
+            img = _decode_file(input_path, flags)
+            if img is None and not os.path.exists(input_path):
+                raise FileNotFoundError(f"輸入圖像文件不存在: {input_path}")
+            return img
+        return _decode_image(input_path, flags, stat.st_mtime_ns, stat.st_size)
+    
+    def _probe_jpeg_size(self, input_path):
+        """
+        只讀取文件標頭取得 JPEG 的顯示尺寸 (width, height)（已套用 EXIF 旋轉）
+        
+        Returns:
+            tuple: 非 JPEG 或無法讀取時為 None
+        """
+        try:
+            with Image.open(input_path) as im:
+                if im.format != 'JPEG':
+                    return None
+                width, height = im.size
+                if im.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+                    width, height = height, width
+                return width, height
+        except (OSError, SyntaxError):
+            return None
+    
+    def get_image_shape(self, path):
+        """
+        只讀取文件標頭取得圖像尺寸，不解碼像素
+        
+        結果與 cv2.imread(path).shape[:2] 相同（已套用 EXIF 旋轉），
+        可作為 recover_crop 的 image_o_shape。
+        
+        Args:
+            path (str): 圖像路徑
+        
+        Returns:
+            tuple: (height, width)
+        
+        Raises:
+            FileNotFoundError: 文件不存在
+            ValueError: 無法辨識的圖像格式
+        """
+        try:
+            with Image.open(path) as im:
+                width, height = im.size
+                if im.format == 'JPEG' and im.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+                    width, height = height, width
+                return height, width
+        except FileNotFoundError:
+            raise FileNotFoundError(f"圖像文件不存在: {path}")
+        except (OSError, SyntaxError) as e:
+            raise ValueError(f"無法讀取圖像尺寸: {path}，{e}")
+    
     def estimate_crop_parameters(self, original_path, template_path):
         """
         估算裁剪參數
@@ -306,12 +1269,11 @@ class WatermarkService:
             Exception: 估算過程中的錯誤
         """
         try:
-            if not os.path.exists(original_path):
-                raise FileNotFoundError(f"原始圖像文件不存在: {original_path}")
-            if not os.path.exists(template_path):
-                raise FileNotFoundError(f"模板圖像文件不存在: {template_path}")
+            self._stat_file(original_path, '原始圖像文件')
+            self._stat_file(template_path, '模板圖像文件')
             
-            logger.info(f"開始估算裁剪參數: 原始={original_path}, 模板={template_path}")
+            logger.info("開始估算裁剪參數: 原始=%s, 模板=%s", original_path, template_path)
+            _load_blind_watermark()
             
             loc, shape, score, scale = recover.estimate_crop_parameters(
                 original_file=original_path,
@@ -325,15 +1287,15 @@ class WatermarkService:
                 'scale': float(scale)
             }
             
-            logger.info(f"裁剪參數估算完成: loc={loc}, scale={scale}, score={score}")
+            logger.info("裁剪參數估算完成: loc=%s, scale=%s, score=%s", loc, scale, score)
             
             return result
             
         except FileNotFoundError as e:
-            logger.error(f"文件未找到錯誤: {e}")
+            logger.error("文件未找到錯誤: %s", e)
             raise
         except Exception as e:
-            logger.error(f"估算裁剪參數時發生錯誤: {e}", exc_info=True)
+            logger.exception("估算裁剪參數時發生錯誤: %s", e)
             raise Exception(f"估算裁剪參數失敗: {str(e)}")
     
     def recover_crop(self, template_path, output_path, loc, image_o_shape):
@@ -346,7 +1308,8 @@ class WatermarkService:
             template_path (str): 裁剪後的圖像路徑
             output_path (str): 恢復後的圖像輸出路徑
             loc (tuple): 裁剪位置 (x1, y1, x2, y2)
-            image_o_shape (tuple): 原始圖像尺寸 (height, width)
+            image_o_shape (tuple): 原始圖像尺寸 (height, width)；
+                只有原始圖像文件時建議用 get_image_shape 讀取，避免為了尺寸解碼整張圖像
         
         Returns:
             str: 輸出圖像路徑
@@ -357,8 +1320,7 @@ class WatermarkService:
             Exception: 恢復過程中的錯誤
         """
         try:
-            if not os.path.exists(template_path):
-                raise FileNotFoundError(f"模板圖像文件不存在: {template_path}")
+            self._stat_file(template_path, '模板圖像文件')
             
             if not isinstance(loc, (tuple, list)) or len(loc) != 4:
                 raise ValueError("裁剪位置 loc 必須是包含4個元素的元組或列表 (x1, y1, x2, y2)")
@@ -366,25 +1328,27 @@ class WatermarkService:
             if not isinstance(image_o_shape, (tuple, list)) or len(image_o_shape) != 2:
                 raise ValueError("原始圖像尺寸 image_o_shape 必須是包含2個元素的元組或列表 (height, width)")
             
-            logger.info(f"開始恢復裁剪: 模板={template_path}, loc={loc}, shape={image_o_shape}")
+            logger.info("開始恢復裁剪: 模板=%s, loc=%s, shape=%s", template_path, loc, image_o_shape)
+            _load_blind_watermark()
             
-            recovered_img = recover.recover_crop(
-                template_file=template_path,
-                output_file_name=output_path,
-                loc=loc,
-                image_o_shape=image_o_shape
-            )
+            with atomic_output(output_path) as tmp_path:
+                recovered_img = recover.recover_crop(
+                    template_file=template_path,
+                    output_file_name=tmp_path,
+                    loc=loc,
+                    image_o_shape=image_o_shape
+                )
             
-            logger.info(f"裁剪恢復完成: {output_path}")
+            logger.info("裁剪恢復完成: %s", output_path)
             
             return output_path
             
         except FileNotFoundError as e:
-            logger.error(f"文件未找到錯誤: {e}")
+            logger.error("文件未找到錯誤: %s", e)
             raise
         except ValueError as e:
-            logger.error(f"參數驗證錯誤: {e}")
+            logger.error("參數驗證錯誤: %s", e)
             raise
         except Exception as e:
-            logger.error(f"恢復裁剪時發生錯誤: {e}", exc_info=True)
+            logger.exception("恢復裁剪時發生錯誤: %s", e)
             raise Exception(f"恢復裁剪失敗: {str(e)}")